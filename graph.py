@@ -7,18 +7,12 @@ from graphviz import Digraph
 # adjust path so minigit.py is importable
 sys.path.append(os.path.dirname(__file__))
 
-from minigit import GitRepository, object_read, GitCommit
+from minigit import Repository, object_read, walk_commits, GitCommit
 
 def plot_commit_graph(repo_path, output_path='commit_graph'):
-    repo = GitRepository(repo_path)
-    head_ref = os.path.join(repo.gitdir, 'refs', 'heads', 'master')
-    with open(head_ref) as f:
-        head_sha = f.read().strip()
-    sha = head_sha
+    repo = Repository(repo_path)
     dot = Digraph('miniwyag')
-    seen = set()
-    while sha and sha not in seen:
-        seen.add(sha)
+    for sha in walk_commits(repo, repo.head):
         commit = object_read(repo, sha)
         dot.node(sha, f"{sha[:7]}\n{commit.message.splitlines()[0]}", shape='box')
         # link commit → its tree
@@ -26,7 +20,6 @@ def plot_commit_graph(repo_path, output_path='commit_graph'):
         plot_tree(repo, dot, commit.tree)
         if commit.parent:
             dot.edge(commit.parent, sha)
-        sha = commit.parent
     dot.render(output_path, format='png', cleanup=True)
 
 def plot_tree(repo, dot, tree_sha):
@@ -1,15 +1,32 @@
 """
 miniwyag.py: Minimal Git-like tool
 
-Commands: init, hash-object, cat-file, add, commit, status, log, ls-objects, rm
+Commands: init, hash-object, cat-file, add, commit, status, diff, log, ls-objects, rm, gc (repack),
+          fsmonitor, commit-graph
 
 Data Structures:
 - GitRepository: Holds paths to the worktree and .minigit directory.
+- Repository: Session over a GitRepository (found from any subdirectory) with HEAD, index and
+  .minigit/config loaded lazily and memoized until their files change.
 - GitObject: Base class for Git objects (Blob, Commit, Tree).
 - GitBlob: Represents file contents.
-- GitCommit: Represents a commit (tree, parent, author, message).
-- GitTree: Represents a directory tree (not fully implemented, but stubbed for completeness).
-- Index: Simple dict mapping file paths to blob SHAs (in-memory, written to .minigit/index as a text file).
+- GitCommit: Represents a commit (tree, parent, author, committer, message); headers are parsed lazily
+  from the raw bytes. Author/committer are "name <email> unix-time +hhmm".
+- GitTree: Represents a directory: (mode, name, sha) entries, with "040000" entries for subtrees.
+- PackFile: A packfile plus its .idx (fanout table + sorted SHAs) for O(log n) lookups;
+  entries may be deltas (copy/insert instructions) against an earlier entry.
+- Change: One path changed between two trees, a tree and the index, or the index and the worktree;
+  diff_trees and diff_index_tree skip subtrees whose SHAs match instead of recursing.
+- CommitGraph: mmap'd file of fixed-width rows (tree, parent position, generation, timestamp) behind a
+  fanout table, so history walks and ancestry checks don't inflate commits.
+- BloomFilters: per-commit Bloom filters of changed paths, so log -- <path> skips untouched commits
+  without reading their trees.
+- CommitMeta: array-typed columns (author/committer time, interned author id) per commit-graph
+  position; log --since/--until/--author scan them instead of reading commits.
+- ObjectCache: Bounded LRU cache of parsed commits/trees keyed by SHA, shared by the whole process.
+- ObjectWriter: Context manager batching object writes (loose or into one pack) with an fsync policy.
+- Index: Dict mapping file paths to IndexEntry (blob SHA + cached stat data), stored in .minigit/index
+  as a versioned binary file with a trailing checksum and extensions (untracked cache, cache-tree).
 
 Concepts and Programming Techniques Used:
 - Classes & Inheritance: Used for GitObject, GitBlob, GitCommit, GitTree to model Git objects.
@@ -17,19 +34,42 @@ Concepts and Programming Techniques Used:
 - Hashing: SHA-1 hashing (via hashlib) to uniquely identify objects (like Git).
 - Compression: zlib used to compress/decompress object data.
 - File I/O: Reading/writing files for objects, index, and refs.
-- Recursion: Used in cmd_add to recursively add files in directories.
+- Directory Walking: walk_worktree (os.scandir) prunes .minigit and ignored directories before descending;
+  used by add and status.
+- FSMonitorDaemon: inotify (ctypes) watcher keeping a token-addressed journal of changed paths.
+- Pattern Matching: .minigitignore globs compiled into one regex per directory (IgnoreMatcher).
 - Sets & Dicts: Used for tracking index, staged, and untracked files.
 - Simple Graph Traversal: The commit history is a singly-linked list (parent pointer), traversed in cmd_log.
 - Command-line Parsing: argparse for CLI interface.
-- Minimal Tree Structure: GitTree class stubbed for completeness (not fully implemented).
+- Merkle Trees: cmd_commit writes nested GitTrees and reuses unchanged subtrees from the parent commit.
+- Line Diff: lines interned to ints; linear-space Myers (with a unique-line fallback) and histogram diff for patches.
 """
 
 import os
+import re
 import sys
 import hashlib
 import zlib
+import struct
+import stat
+import math
+import mmap
+import time
+import bisect
+import socket
+import selectors
+import subprocess
+import ctypes
+import ctypes.util
+import tempfile
+import shutil
 import argparse
-from datetime import datetime
+import array
+import itertools
+import configparser
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 # ----------------------
 # Data Structures
@@ -39,8 +79,13 @@ class GitRepository:
     def __init__(self, path):
         self.worktree = os.path.abspath(path)
         self.gitdir = os.path.join(self.worktree, ".minigit")
+        self.packs = None  # list of PackFile, opened lazily by repo_packs()
+        self.commit_graph = None  # CommitGraph, opened lazily by repo_commit_graph()
+        self.commit_meta = None   # CommitMeta, loaded lazily by repo_commit_meta()
+        self.commit_bloom = None  # BloomFilters, loaded lazily by repo_commit_bloom()
 
 class GitObject:
+    __slots__ = ()
     def serialize(self):
         raise NotImplementedError
     @classmethod
@@ -57,40 +102,90 @@ class GitBlob(GitObject):
         return cls(data)
 
 class GitCommit(GitObject):
-    def __init__(self, tree, parent, author, message):
-        self.tree = tree
-        self.parent = parent
-        self.author = author
-        self.message = message
+    """
+    A commit read from the object store keeps its raw bytes: the header
+    lines are parsed on first access to tree/parent/author, and the message
+    is decoded only when asked for. Walking history by parent never touches
+    the message at all.
+    """
+    __slots__ = ("_raw", "_parsed", "_tree", "_parent", "_author", "_committer", "_message")
+
+    def __init__(self, tree, parent, author, message, committer=None):
+        self._raw = None
+        self._parsed = True
+        self._tree = tree
+        self._parent = parent
+        self._author = author
+        self._committer = committer or author
+        self._message = message
+
+    def _parse(self):
+        raw = self._raw
+        end = raw.find(b"\n\n")
+        self._tree = self._parent = self._author = self._committer = None
+        for line in (raw if end < 0 else raw[:end]).split(b"\n"):
+            key, _, value = line.partition(b" ")
+            if key == b"tree":
+                self._tree = value.decode()
+            elif key == b"parent":
+                if self._parent is None:
+                    self._parent = value.decode()
+            elif key == b"author":
+                self._author = value.decode()
+            elif key == b"committer":
+                self._committer = value.decode()
+        self._parsed = True
+
+    @property
+    def tree(self):
+        if not self._parsed:
+            self._parse()
+        return self._tree
+
+    @property
+    def parent(self):
+        if not self._parsed:
+            self._parse()
+        return self._parent
+
+    @property
+    def author(self):
+        if not self._parsed:
+            self._parse()
+        return self._author
+
+    @property
+    def committer(self):
+        if not self._parsed:
+            self._parse()
+        return self._committer
+
+    @property
+    def message(self):
+        if self._message is None:
+            end = self._raw.find(b"\n\n")
+            self._message = "" if end < 0 else self._raw[end + 2:].decode()
+        return self._message
+
     def serialize(self):
+        if self._raw is not None:
+            return self._raw
         lines = [f"tree {self.tree}"]
         if self.parent:
             lines.append(f"parent {self.parent}")
         lines.append(f"author {self.author}")
-        lines.append(f"committer {self.author}")
+        lines.append(f"committer {self.committer}")
         lines.append("")
         lines.append(self.message)
         return "\n".join(lines).encode()
+
     @classmethod
     def deserialize(cls, data):
-        lines = data.decode().splitlines()
-        tree = None
-        parent = None
-        author = None
-        message = []
-        i = 0
-        while i < len(lines):
-            if lines[i].startswith("tree "):
-                tree = lines[i][5:]
-            elif lines[i].startswith("parent "):
-                parent = lines[i][7:]
-            elif lines[i].startswith("author "):
-                author = lines[i][7:]
-            elif lines[i] == "":
-                message = "\n".join(lines[i+1:])
-                break
-            i += 1
-        return cls(tree, parent, author, message)
+        commit = cls.__new__(cls)
+        commit._raw = bytes(data)
+        commit._parsed = False
+        commit._message = None
+        return commit
 
 class GitTree(GitObject):
     # Merkle-tree: list of (mode, path, sha)
@@ -116,25 +211,208 @@ class GitTree(GitObject):
             sha_bytes = data[j+1:j+21]
             entries.append((mode, path, sha_bytes.hex()))
             i = j + 21
-        return cls(entries)
+        # Tuple, not list: parsed trees are shared through the object cache
+        return cls(tuple(entries))
+
+# ----------------------
+# Index
+# ----------------------
+# The index maps relpath -> IndexEntry (blob SHA plus the stat data the file
+# had when it was hashed). On disk it is a versioned binary file:
+#
+#   "MGIX" | version u32 | entry count u32
+#   entries, sorted by path:
+#       ctime_ns i64 | mtime_ns i64 | ino u64 | mode u32 | size u64
+#       | 20-byte SHA | flags u16 | path length u16 | path (utf-8)
+#   extensions: signature (4 bytes) | size u32 | data
+#   sha1 of everything above
+#
+# Readers skip extensions they don't know. Known extensions:
+#   UNTC  untracked cache (see untracked_files); replaces UNTR, whose
+#         listings left out tracked files and are ignored now
+#   FSMN  fsmonitor token (see fsmonitor_refresh)
+#   TREE  cache-tree: tree SHA of each directory whose entries haven't
+#         changed since the last write_tree (see cache_tree_invalidate)
+#
+# Older repositories have a text index ("path sha" per line); it is still
+# read, and rewritten in the binary format on the next write.
+
+INDEX_SIGNATURE = b'MGIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct(">4sII")
+INDEX_ENTRY = struct.Struct(">qqQIQ20sHH")
+INDEX_EXTENSION = struct.Struct(">4sI")
+
+class Index(dict):
+    """
+    relpath -> IndexEntry, plus the extension data stored alongside.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # directory prefix -> UntrackedDir, or None if there is no cache yet
+        self.untracked = None
+        # Last token from the fsmonitor daemon, or None if it isn't in use
+        self.fsmonitor_token = None
+        # directory prefix ("" for the root) -> (entry count, tree sha)
+        self.cache_tree = {}
+
+class IndexEntry:
+    __slots__ = ("sha", "ctime_ns", "mtime_ns", "ino", "mode", "size", "flags")
+
+    def __init__(self, sha, ctime_ns=0, mtime_ns=0, ino=0, mode=0o100644, size=0, flags=0):
+        self.sha = sha
+        self.ctime_ns = ctime_ns
+        self.mtime_ns = mtime_ns
+        self.ino = ino
+        self.mode = mode
+        self.size = size
+        self.flags = flags
+
+    @classmethod
+    def from_stat(cls, sha, st):
+        return cls(sha, st.st_ctime_ns, st.st_mtime_ns, st.st_ino, st.st_mode, st.st_size)
+
+def index_mtime_ns(repo):
+    try:
+        return os.stat(os.path.join(repo.gitdir, "index")).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def stat_matches(entry, st, racy_ns):
+    """
+    True if st is the stat data recorded when entry was hashed, i.e. the file
+    can be treated as unchanged without rehashing it. An entry whose mtime is
+    not older than the index file (racy_ns) never matches: the file may have
+    been changed again within the same timestamp tick after it was hashed.
+    """
+    return (entry.mtime_ns == st.st_mtime_ns and entry.ctime_ns == st.st_ctime_ns
+            and entry.size == st.st_size and entry.ino == st.st_ino
+            and entry.mode == st.st_mode and entry.mtime_ns < racy_ns)
+
+def seed_index_from_head(repo, index):
+    """
+    Fill index with the files of the HEAD commit. Stat data is left empty,
+    so the files are rehashed (and their entries refreshed) on first use.
+    """
+    head = head_commit(repo)
+    if head is None:
+        return
+    for path, (mode, sha) in tree_file_entries(repo, object_read(repo, head).tree).items():
+        index[path.replace("/", os.sep)] = IndexEntry(sha, mode=0o100755 if mode == "100755" else 0o100644)
 
-# Index: simple text file mapping relpath to blob sha
-# Example line: "second_file.txt 123abc..."
 def read_index(repo):
     index_path = os.path.join(repo.gitdir, "index")
-    index = {}
-    if os.path.exists(index_path):
-        with open(index_path) as f:
-            for line in f:
-                path, sha = line.strip().split()
-                index[path] = sha
+    index = Index()
+    if not os.path.exists(index_path):
+        # Only repositories from before the binary index commit without
+        # leaving an index behind
+        seed_index_from_head(repo, index)
+        return index
+    with open(index_path, "rb") as f:
+        data = f.read()
+    if not data.startswith(INDEX_SIGNATURE):
+        # Legacy text index: "path sha" per line, no stat data. It only held
+        # what was added since the last commit (commit emptied it), while
+        # the index is now the whole next snapshot: start from HEAD.
+        seed_index_from_head(repo, index)
+        for line in data.decode().splitlines():
+            if line.strip():
+                path, sha = line.strip().rsplit(" ", 1)
+                index[path] = IndexEntry(sha)
+        return index
+    view = memoryview(data)
+    if hashlib.sha1(view[:-20]).digest() != data[-20:]:
+        raise Exception("Index checksum mismatch; the index file is corrupt.")
+    _, version, count = INDEX_HEADER.unpack_from(data, 0)
+    if version != INDEX_VERSION:
+        raise Exception(f"Unsupported index version {version}.")
+    pos = INDEX_HEADER.size
+    unpack = INDEX_ENTRY.unpack_from
+    entry_size = INDEX_ENTRY.size
+    for _ in range(count):
+        ctime_ns, mtime_ns, ino, mode, size, sha, flags, path_len = unpack(data, pos)
+        pos += entry_size
+        path = str(view[pos:pos + path_len], "utf-8", "surrogateescape")
+        pos += path_len
+        index[path] = IndexEntry(sha.hex(), ctime_ns, mtime_ns, ino, mode, size, flags)
+    while pos < len(data) - 20:
+        sig, size = INDEX_EXTENSION.unpack_from(data, pos)
+        pos += INDEX_EXTENSION.size
+        body = view[pos:pos + size]
+        pos += size
+        if sig == b'UNTC':
+            index.untracked = decode_untracked_cache(body)
+        elif sig == b'FSMN':
+            index.fsmonitor_token = str(body, "utf-8")
+        elif sig == b'TREE':
+            index.cache_tree = decode_cache_tree(body)
     return index
 
 def write_index(repo, index):
     index_path = os.path.join(repo.gitdir, "index")
-    with open(index_path, "w") as f:
-        for path, sha in index.items():
-            f.write(f"{path} {sha}\n")
+    out = bytearray(INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(index)))
+    pack = INDEX_ENTRY.pack
+    for path in sorted(index):
+        e = index[path]
+        raw_path = path.encode("utf-8", "surrogateescape")
+        out += pack(e.ctime_ns, e.mtime_ns, e.ino, e.mode, e.size, bytes.fromhex(e.sha), e.flags, len(raw_path))
+        out += raw_path
+    untracked = getattr(index, "untracked", None)
+    if untracked is not None:
+        body = encode_untracked_cache(untracked)
+        out += INDEX_EXTENSION.pack(b'UNTC', len(body)) + body
+    cache_tree = getattr(index, "cache_tree", None)
+    if cache_tree:
+        body = encode_cache_tree(cache_tree)
+        out += INDEX_EXTENSION.pack(b'TREE', len(body)) + body
+    token = getattr(index, "fsmonitor_token", None)
+    if token is not None:
+        body = token.encode()
+        out += INDEX_EXTENSION.pack(b'FSMN', len(body)) + body
+    out += hashlib.sha1(out).digest()
+    # Write to a lock file and rename, so readers never see a partial index
+    lock_path = index_path + ".lock"
+    with open(lock_path, "wb") as f:
+        f.write(out)
+    os.replace(lock_path, index_path)
+
+CACHE_TREE_ENTRY = struct.Struct(">I20s")
+
+def encode_cache_tree(cache_tree):
+    out = bytearray(struct.pack(">I", len(cache_tree)))
+    for prefix in sorted(cache_tree):
+        count, sha = cache_tree[prefix]
+        raw = prefix.encode("utf-8", "surrogateescape")
+        out += struct.pack(">H", len(raw)) + raw + CACHE_TREE_ENTRY.pack(count, bytes.fromhex(sha))
+    return bytes(out)
+
+def decode_cache_tree(data):
+    cache_tree = {}
+    (n,) = struct.unpack_from(">I", data, 0)
+    pos = 4
+    for _ in range(n):
+        (length,) = struct.unpack_from(">H", data, pos)
+        pos += 2
+        prefix = str(data[pos:pos + length], "utf-8", "surrogateescape")
+        pos += length
+        count, sha = CACHE_TREE_ENTRY.unpack_from(data, pos)
+        pos += CACHE_TREE_ENTRY.size
+        cache_tree[prefix] = (count, sha.hex())
+    return cache_tree
+
+def cache_tree_invalidate(index, relpath):
+    """
+    Drop the cached tree of every directory containing relpath: exactly the
+    trees whose content changes when that entry is added, changed or removed.
+    """
+    cache_tree = getattr(index, "cache_tree", None)
+    if not cache_tree:
+        return
+    cache_tree.pop("", None)
+    i = relpath.find(os.sep)
+    while i >= 0:
+        cache_tree.pop(relpath[:i + 1], None)
+        i = relpath.find(os.sep, i + 1)
 
 # ----------------------
 # Utility Functions
@@ -150,21 +428,138 @@ def repo_create(path):
     os.makedirs(os.path.join(gitdir, "refs", "heads"), exist_ok=True)
     print(f"[miniwyag] Initialized empty repository at {os.path.abspath(gitdir)}")
 
+def object_path(repo, sha):
+    return os.path.join(repo.gitdir, "objects", sha[:2], sha[2:])
+
+def object_exists(repo, sha):
+    for pack in repo_packs(repo):
+        if pack.find(sha) is not None:
+            return True
+    return os.path.exists(object_path(repo, sha))
+
 def object_write(obj, repo, fmt):
     data = obj.serialize()
     header = f"{fmt} {len(data)}".encode() + b'\x00'
     full = header + data
     sha = hashlib.sha1(full).hexdigest()
-    obj_path = os.path.join(repo.gitdir, "objects", sha[:2], sha[2:])
+    obj_path = object_path(repo, sha)
     obj_dir = os.path.dirname(obj_path)
     os.makedirs(obj_dir, exist_ok=True)
-    if not os.path.exists(obj_path):
+    if not object_exists(repo, sha):
         with open(obj_path, "wb") as f:
             f.write(zlib.compress(full))
     return sha
 
-def object_read(repo, sha):
-    obj_path = os.path.join(repo.gitdir, "objects", sha[:2], sha[2:])
+# Files are hashed and compressed through a buffer of this size, so storing
+# a blob needs the same amount of memory whatever the file size is.
+STREAM_CHUNK = 1024 * 1024
+
+def deflate_stream(src, dst, header, include_header=True):
+    """
+    Copy src to dst as one zlib stream through a fixed-size buffer, feeding
+    header + content to a running SHA-1 on the way. Pack entries keep the
+    header out of the compressed data (include_header=False).
+    Returns (sha, number of content bytes copied).
+    """
+    sha1 = hashlib.sha1(header)
+    compressor = zlib.compressobj()
+    if include_header:
+        dst.write(compressor.compress(header))
+    buf = bytearray(STREAM_CHUNK)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        sha1.update(view[:n])
+        dst.write(compressor.compress(view[:n]))
+        total += n
+    dst.write(compressor.flush())
+    return sha1.hexdigest(), total
+
+def deflate_to_temp(tmp_dir, path, fmt="blob", include_header=True):
+    """
+    Worker half of a parallel add: compress a file into a temp file and
+    return (sha, size, tmp_path) for ObjectWriter.adopt to take over. Kept at
+    module level so a process pool can pickle it.
+    """
+    with open(path, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        header = f"{fmt} {size}".encode() + b'\x00'
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                sha, total = deflate_stream(src, dst, header, include_header)
+            if total != size:
+                raise Exception(f"{path} changed while it was being hashed.")
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return sha, size, tmp_path
+
+# Files per task handed to a worker in a parallel add
+PARALLEL_BATCH = 32
+
+def deflate_batch_to_temp(tmp_dir, paths, fmt="blob", include_header=True):
+    results = []
+    try:
+        for path in paths:
+            results.append(deflate_to_temp(tmp_dir, path, fmt, include_header))
+    except BaseException:
+        for _, _, tmp_path in results:
+            os.remove(tmp_path)
+        raise
+    return results
+
+def object_write_file(repo, path, fmt="blob"):
+    """
+    Stream a file into the object store: one pass feeds a running SHA-1 and a
+    zlib compressor into a temp file, which is then renamed into place.
+    """
+    objects_dir = os.path.join(repo.gitdir, "objects")
+    with open(path, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        header = f"{fmt} {size}".encode() + b'\x00'
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=objects_dir)
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                sha, total = deflate_stream(src, dst, header)
+            if total != size:
+                raise Exception(f"{path} changed while it was being hashed.")
+            if object_exists(repo, sha):
+                os.remove(tmp_path)
+            else:
+                obj_path = object_path(repo, sha)
+                os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+                os.replace(tmp_path, obj_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return sha
+
+def hash_file(path, fmt="blob"):
+    """
+    SHA of a file as an object, computed in chunks without storing it.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        sha1 = hashlib.sha1(f"{fmt} {size}".encode() + b'\x00')
+        for chunk in iter(lambda: f.read(STREAM_CHUNK), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def object_read_raw(repo, sha):
+    """
+    Return (fmt, data) for an object. Packs are searched first (binary search
+    in each .idx), loose objects are the fallback.
+    """
+    for pack in repo_packs(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.read(offset)
+    obj_path = object_path(repo, sha)
     if not os.path.exists(obj_path):
         raise Exception(f"Object {sha} not found.")
     with open(obj_path, "rb") as f:
@@ -174,281 +569,3593 @@ def object_read(repo, sha):
     fmt = full[:x]
     size = int(full[x+1:y])
     data = full[y+1:]
+    return fmt, data
+
+def inflate_chunks(f, chunk_size=STREAM_CHUNK):
+    """
+    Yield the decompressed content of the zlib stream starting at f's
+    current position, never more than chunk_size bytes at a time.
+    """
+    d = zlib.decompressobj()
+    while not d.eof:
+        buf = d.unconsumed_tail or f.read(chunk_size)
+        if not buf:
+            raise Exception("Truncated zlib stream.")
+        out = d.decompress(buf, chunk_size)
+        if out:
+            yield out
+
+def inflate_prefix(f, n):
+    """
+    Inflate only as much of the zlib stream at f's position as it takes to
+    produce n bytes (fewer if the stream is shorter).
+    """
+    d = zlib.decompressobj()
+    out = b''
+    while len(out) < n and not d.eof:
+        buf = f.read(64)
+        if not buf:
+            break
+        out += d.decompress(buf, n - len(out))
+    return out
+
+def object_header(repo, sha):
+    """
+    Return (fmt, size) of an object by inflating just its header, instead of
+    the whole object as object_read does.
+    """
+    for pack in repo_packs(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.header(offset)
+    obj_path = object_path(repo, sha)
+    if not os.path.exists(obj_path):
+        raise Exception(f"Object {sha} not found.")
+    with open(obj_path, "rb") as f:
+        # "<fmt> <size>\0" is at most ~30 bytes
+        head = inflate_prefix(f, 32)
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    if x < 0 or y < 0:
+        raise Exception(f"Object {sha} has a corrupt header.")
+    return head[:x], int(head[x+1:y])
+
+def _closing(f, chunks):
+    try:
+        yield from chunks
+    finally:
+        f.close()
+
+def object_stream(repo, sha, chunk_size=STREAM_CHUNK):
+    """
+    Return (fmt, size, chunks) where chunks yields the object's content as it
+    is inflated, so large blobs can be copied out in constant memory.
+    """
+    for pack in repo_packs(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.stream(offset, chunk_size)
+    obj_path = object_path(repo, sha)
+    if not os.path.exists(obj_path):
+        raise Exception(f"Object {sha} not found.")
+    f = open(obj_path, "rb")
+    chunks = inflate_chunks(f, chunk_size)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if b'\x00' in head:
+            break
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    if x < 0 or y < 0:
+        f.close()
+        raise Exception(f"Object {sha} has a corrupt header.")
+    fmt = head[:x]
+    size = int(head[x+1:y])
+    def body():
+        if len(head) > y + 1:
+            yield head[y+1:]
+        yield from chunks
+    return fmt, size, _closing(f, body())
+
+def object_read(repo, sha):
+    obj = object_cache.get(sha)
+    if obj is not None:
+        return obj
+    fmt, data = object_read_raw(repo, sha)
     if fmt == b'blob':
         return GitBlob.deserialize(data)
     elif fmt == b'commit':
-        return GitCommit.deserialize(data)
+        obj = GitCommit.deserialize(data)
     elif fmt == b'tree':
-        return GitTree.deserialize(data)
+        obj = GitTree.deserialize(data)
     else:
         raise Exception(f"Unknown object type: {fmt}")
+    object_cache.put(sha, obj, len(data))
+    return obj
 
-# ----------------------
-# Commands
-# ----------------------
-
-def cmd_init(args):
-    repo_create(args.path)
-
-def cmd_hash_object(args):
-    repo = GitRepository(os.getcwd())
-    with open(args.file, "rb") as f:
-        data = f.read()
-    blob = GitBlob(data)
-    sha = object_write(blob, repo, "blob")
-    print(sha)
-
-def cmd_cat_file(args):
-    repo = GitRepository(os.getcwd())
-    obj = object_read(repo, args.sha)
-    if args.type == "blob":
-        sys.stdout.buffer.write(obj.data)
-    elif args.type == "commit":
-        print(obj.serialize().decode())
-    else:
-        print("Unsupported type for cat-file.")
-
-def cmd_add(args):
-    repo = GitRepository(os.getcwd())
-    index = read_index(repo)
-    # Build set of tracked files (from index and last commit)
-    head_ref = os.path.join(repo.gitdir, "refs", "heads", "master")
-    tracked = set(index.keys())
-    if os.path.exists(head_ref):
-        with open(head_ref) as f:
-            sha = f.read().strip()
-        if sha:
-            commit = object_read(repo, sha)
-            msg = commit.message
-            if "[files]" in msg:
-                files_section = msg.split("[files]", 1)[1]
-                tracked |= set(line.strip() for line in files_section.strip().splitlines() if line.strip())
-    def add_path(path):
-        if os.path.isdir(path):
-            for root, _, files in os.walk(path):
-                # Skip .minigit directory
-                if '.minigit' in root:
-                    continue
-                for f in files:
-                    add_path(os.path.join(root, f))
-        elif os.path.isfile(path):
-            relpath = os.path.relpath(path, repo.worktree)
-            if relpath in tracked:
-                return  # Skip already tracked files
-            with open(path, "rb") as f:
-                data = f.read()
-            blob = GitBlob(data)
-            sha = object_write(blob, repo, "blob")
-            index[relpath] = sha
-            print(f"Added {relpath} (blob SHA: {sha})")
-    for path in args.files:
-        add_path(path)
-    write_index(repo, index)
-
-def cmd_rm(args):
+def tree_file_entries(repo, tree_sha, prefix=""):
     """
-    Remove specified files from the index (untrack them).
+    Flatten a tree into {path: (mode, blob sha)}, descending into subtrees.
     """
-    repo = GitRepository(os.getcwd())
-    index = read_index(repo)
-    removed = False
-    for path in args.files:
-        relpath = os.path.relpath(path, repo.worktree)
-        if relpath in index:
-            del index[relpath]
-            print(f"Untracked {relpath}")
-            removed = True
+    files = {}
+    for mode, path, sha in object_read(repo, tree_sha).entries:
+        if mode == "040000":
+            files.update(tree_file_entries(repo, sha, prefix + path + "/"))
         else:
-            print(f"{relpath} is not tracked.")
-    if removed:
-        write_index(repo, index)
+            files[prefix + path] = (mode, sha)
+    return files
 
-def cmd_commit(args):
-    repo = GitRepository(os.getcwd())
-    index = read_index(repo)
-    # Get tracked files from last commit
-    head_ref = os.path.join(repo.gitdir, "refs", "heads", "master")
-    os.makedirs(os.path.dirname(head_ref), exist_ok=True)  # Ensure directory exists
-    parent = None
-    prev_tracked = {}
-    if os.path.exists(head_ref):
-        with open(head_ref) as f:
-            parent = f.read().strip() or None
-        if parent:
-            commit = object_read(repo, parent)
-            msg = commit.message
-            if "[files]" in msg:
-                files_section = msg.split("[files]", 1)[1]
-                for line in files_section.strip().splitlines():
-                    if line.strip():
-                        # Each line is a file path
-                        path = line.strip()
-                        # Try to get the blob sha from the previous commit's tree (not implemented, so fallback to index)
-                        # In a real implementation, parse the tree object. Here, we just keep the path.
-                        prev_tracked[path] = None  # Value not used, just track the path
-    # Merge previous tracked files with current index
-    # If a file is in index, use the new blob sha; if only in prev_tracked, keep it; if removed from index, drop it
-    new_tracked = dict(prev_tracked)
-    for k in index:
-        new_tracked[k] = index[k]
-    # Remove files that were removed from index (rm command)
-    for k in list(new_tracked.keys()):
-        if k not in index and k not in prev_tracked:
-            del new_tracked[k]
-    if not new_tracked:
-        print("Nothing to commit.")
-        return
-    # Build real tree entries from tracked files
-    entries = []
-    for path, blob_sha in sorted(new_tracked.items()):
-        if blob_sha is None:
-            continue  # skip unstaged/unhashed files
-        mode = "100644"
-        entries.append((mode, path, blob_sha))
-    tree = GitTree(entries)
-    tree_sha = object_write(tree, repo, "tree")
-    author = f"{os.getenv('USER', 'user')} <{os.getenv('USER', 'user')}@localhost>"
-    message = args.message or f"Commit at {datetime.now()}"
-    # Store file list in commit message for demo
-    message += "\n\n[files]\n" + "\n".join(sorted(new_tracked.keys()))
-    commit = GitCommit(tree_sha, parent, author, message)
-    commit_sha = object_write(commit, repo, "commit")
-    with open(head_ref, "w") as f:
-        f.write(commit_sha + "\n")
-    print(f"Committed as {commit_sha}")
-    write_index(repo, {})  # Clear the index after commit
+def is_flat_tree(entries):
+    # Commits from before nested trees have one tree whose entry names
+    # are whole paths ("d/x")
+    return any("/" in name for mode, name, sha in entries)
 
-def cmd_status(args):
-    repo = GitRepository(os.getcwd())
-    index = read_index(repo)
-    # Get tracked files from last commit
+def head_commit(repo):
+    """
+    Return the SHA HEAD points at, or None before the first commit.
+    """
     head_ref = os.path.join(repo.gitdir, "refs", "heads", "master")
-    tracked = set()
-    if os.path.exists(head_ref):
-        with open(head_ref) as f:
-            sha = f.read().strip()
-        if sha:
-            commit = object_read(repo, sha)
-            msg = commit.message
-            if "[files]" in msg:
-                files_section = msg.split("[files]", 1)[1]
-                tracked = set(line.strip() for line in files_section.strip().splitlines() if line.strip())
-    print("Staged files:")
-    for path in sorted(index.keys()):
-        print(f"  {path}")
-    # Find untracked files
-    all_files = set()
-    for root, _, files in os.walk(repo.worktree):
-        if root.startswith(repo.gitdir):
-            continue
-        for f in files:
-            rel = os.path.relpath(os.path.join(root, f), repo.worktree)
-            all_files.add(rel)
-    untracked = sorted(all_files - tracked - set(index.keys()))
-    print("Untracked files:")
-    for path in untracked:
-        print(f"  {path}")
+    if not os.path.exists(head_ref):
+        return None
+    with open(head_ref) as f:
+        return f.read().strip() or None
 
-def cmd_log(args):
+def tree_mode(entry):
+    return "100755" if entry.mode & 0o111 else "100644"
+
+def write_tree(repo, writer, index, old_tree=None):
     """
-    Simple graph traversal: Each commit points to its parent (linked list).
-    Traverses history from HEAD back to root.
+    Write the index as nested trees (040000 entries for subdirectories) and
+    return the root tree SHA. Directories still in the index's cache-tree are
+    taken from it without looking at their entries at all. For the others,
+    any directory whose entries come out identical to the matching subtree of
+    old_tree (the parent commit's tree) reuses that SHA, so only changed
+    directories are serialized, hashed and written. The cache-tree is
+    refilled for every directory on the way.
     """
-    repo = GitRepository(os.getcwd())
-    head_ref = os.path.join(repo.gitdir, "refs", "heads", "master")
-    if args.sha:
-        sha = args.sha
-    elif os.path.exists(head_ref):
-        with open(head_ref) as f:
-            sha = f.read().strip()
-    else:
-        print("No commits found.")
-        return
-    seen = set()
-    while sha and sha not in seen:
-        seen.add(sha)
-        try:
-            commit = object_read(repo, sha)  # Uses GitCommit
-        except Exception as e:
-            print(f"Broken commit {sha}: {e}")
-            break
-        print(f"commit {sha}")
-        print(f"Author: {commit.author}")
-        print(f"Message: {commit.message}\n")
-        sha = commit.parent
+    paths = sorted(index)
+    cache_tree = index.cache_tree
 
-def cmd_ls_objects(args):
+    def build(lo, hi, prefix, old_sha):
+        cached = cache_tree.get(prefix)
+        if cached is not None and cached[0] == hi - lo:
+            return cached[1]
+        old_entries = {}
+        old = None
+        if old_sha:
+            old = object_read(repo, old_sha)
+            old_entries = {name: sha for mode, name, sha in old.entries if mode == "040000"}
+        entries = []
+        i = lo
+        while i < hi:
+            rest = paths[i][len(prefix):]
+            slash = rest.find(os.sep)
+            if slash < 0:
+                entry = index[paths[i]]
+                entries.append((tree_mode(entry), rest, entry.sha))
+                i += 1
+                continue
+            name = rest[:slash]
+            sub = prefix + name + os.sep
+            # Everything under sub/ sorts before sub + the next character
+            j = bisect.bisect_left(paths, prefix + name + chr(ord(os.sep) + 1), i, hi)
+            entries.append(("040000", name, build(i, j, sub, old_entries.get(name))))
+            i = j
+        entries = tuple(entries)
+        if old is not None and entries == old.entries:
+            sha = old_sha
+        else:
+            sha = writer.write(GitTree(entries), "tree")
+        cache_tree[prefix] = (hi - lo, sha)
+        return sha
+
+    # Directories that no longer exist must not linger in the cache-tree
+    for prefix in list(cache_tree):
+        if prefix:
+            i = bisect.bisect_left(paths, prefix)
+            if i == len(paths) or not paths[i].startswith(prefix):
+                del cache_tree[prefix]
+    return build(0, len(paths), "", old_tree)
+
+def loose_objects(repo):
     """
-    List all objects in the object database (blobs, commits, trees).
-    Uses: GitRepository, object_read, GitBlob, GitCommit, GitTree
+    Yield the SHA of every loose object under .minigit/objects/xx/.
     """
-    repo = GitRepository(os.getcwd())
     objects_dir = os.path.join(repo.gitdir, "objects")
     for d in sorted(os.listdir(objects_dir)):
         if len(d) != 2:
             continue
         subdir = os.path.join(objects_dir, d)
         for f in sorted(os.listdir(subdir)):
-            sha = d + f
-            try:
-                obj = object_read(repo, sha)
-                if isinstance(obj, GitCommit):
-                    typ = "commit"
-                elif isinstance(obj, GitBlob):
-                    typ = "blob"
-                elif isinstance(obj, GitTree):
-                    typ = "tree"
-                else:
-                    typ = "unknown"
-                print(f"{sha} {typ}")
-            except Exception:
-                print(f"{sha} (unreadable)")
+            yield d + f
 
 # ----------------------
-# Argument Parser
+# Object Cache
 # ----------------------
 
-def main():
-    parser = argparse.ArgumentParser(description="miniwyag: minimal git-like tool")
-    subparsers = parser.add_subparsers(dest="command", required=True)
+class ObjectCache:
+    """
+    Process-wide LRU cache of parsed commits and trees, keyed by SHA.
+    Objects are content-addressed, so an entry can never go stale; the only
+    policy needed is eviction once the byte budget is exceeded. Blobs are not
+    cached: they can be huge and are rarely read twice.
+    """
+    # Rough per-entry overhead of the parsed Python objects
+    ENTRY_OVERHEAD = 200
 
-    p_init = subparsers.add_parser("init", help="Initialize a new repository")
-    p_init.add_argument("path", nargs="?", default=".", help="Directory to initialize")
-    p_init.set_defaults(func=cmd_init)
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # sha -> (obj, cost), oldest first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
 
-    p_hash = subparsers.add_parser("hash-object", help="Hash a file as a blob")
-    p_hash.add_argument("file", help="File to hash")
-    p_hash.set_defaults(func=cmd_hash_object)
+    def get(self, sha):
+        entry = self.entries.get(sha)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(sha)
+        self.hits += 1
+        return entry[0]
 
-    p_cat = subparsers.add_parser("cat-file", help="Show object content")
-    p_cat.add_argument("type", choices=["blob", "commit"], help="Type of object")
-    p_cat.add_argument("sha", help="SHA of object")
-    p_cat.set_defaults(func=cmd_cat_file)
+    def put(self, sha, obj, size):
+        cost = size + self.ENTRY_OVERHEAD
+        if cost > self.max_bytes or sha in self.entries:
+            return
+        self.entries[sha] = (obj, cost)
+        self.size += cost
+        self._evict()
 
-    p_add = subparsers.add_parser("add", help="Add file(s) to index")
-    p_add.add_argument("files", nargs="+", help="Files to add")
-    p_add.set_defaults(func=cmd_add)
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
 
-    p_rm = subparsers.add_parser("rm", help="Remove file(s) from index (untrack)")
-    p_rm.add_argument("files", nargs="+", help="Files to untrack")
-    p_rm.set_defaults(func=cmd_rm)
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
 
-    p_commit = subparsers.add_parser("commit", help="Commit staged files")
-    p_commit.add_argument("-m", "--message", help="Commit message")
-    p_commit.set_defaults(func=cmd_commit)
+    def _evict(self):
+        while self.size > self.max_bytes:
+            _, (_, cost) = self.entries.popitem(last=False)
+            self.size -= cost
 
-    p_status = subparsers.add_parser("status", help="Show staged and untracked files")
-    p_status.set_defaults(func=cmd_status)
+    def stats(self):
+        return f"object cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} objects, {self.size}/{self.max_bytes} bytes"
 
-    p_log = subparsers.add_parser("log", help="Show commit history")
-    p_log.add_argument("sha", nargs="?", help="Start from this commit SHA (default: HEAD)")
-    p_log.set_defaults(func=cmd_log)
+# Budget can be set per process with MINIGIT_CACHE_BYTES (default 32 MiB),
+# or per repository with cache.bytes in its config
+OBJECT_CACHE_BYTES = int(os.environ.get("MINIGIT_CACHE_BYTES", 32 * 1024 * 1024))
+object_cache = ObjectCache(OBJECT_CACHE_BYTES)
 
-    p_lsobj = subparsers.add_parser("ls-objects", help="List all objects in the database")
-    p_lsobj.set_defaults(func=cmd_ls_objects)
+# ----------------------
+# Packfiles
+# ----------------------
+# A pack is one data file holding many zlib streams back to back, plus an
+# .idx that maps SHA -> offset. Layout (modelled on Git's pack v2):
+#
+#   .pack: "PACK" | version u32 | count u32 | entries... | sha1 of all of the above
+#          entry = type/size varint header + zlib(data)
+#   .idx:  "\xfftOc" | version u32 | fanout 256 x u32 | sorted 20-byte SHAs
+#          | offsets u64 (same order) | pack checksum | sha1 of the .idx
+#
+# An entry can also be an OFS_DELTA: its header is followed by the distance
+# back to its base entry, and its zlib data is a delta (see create_delta) that
+# rebuilds the object from the base.
+#
+# fanout[b] is the number of SHAs whose first byte is <= b, so a lookup is a
+# binary search inside [fanout[b-1], fanout[b]).
+
+PACK_SIGNATURE = b'PACK'
+PACK_IDX_SIGNATURE = b'\xfftOc'
+PACK_VERSION = 2
+
+# Object type codes (same numbering as Git)
+PACK_TYPES = {b'commit': 1, b'tree': 2, b'blob': 3}
+PACK_TYPE_NAMES = {v: k for k, v in PACK_TYPES.items()}
+PACK_OFS_DELTA = 6
+
+# Delta search defaults for gc: how many previous objects to try as a base,
+# how long a chain of deltas may get before we store a full object, and how
+# much memory the objects in the window (and their delta indexes) may take.
+PACK_WINDOW = 10
+PACK_DEPTH = 50
+PACK_WINDOW_MEMORY = 256 * 1024 * 1024
+
+def pack_dir(repo):
+    return os.path.join(repo.gitdir, "objects", "pack")
+
+def repo_packs(repo):
+    """
+    Open every pack once per repository object. Each PackFile keeps a single
+    file handle, so reading N packed objects costs no extra open() calls.
+    """
+    if repo.packs is None:
+        repo.packs = []
+        d = pack_dir(repo)
+        if os.path.isdir(d):
+            for name in sorted(os.listdir(d)):
+                if name.endswith(".idx"):
+                    repo.packs.append(PackFile(os.path.join(d, name)))
+    return repo.packs
+
+def pack_entry_header(type_num, size):
+    # First byte: continuation bit, 3 type bits, low 4 size bits;
+    # then 7 size bits per byte, least significant first.
+    byte = (type_num << 4) | (size & 0x0f)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(byte | 0x80)
+        byte = size & 0x7f
+        size >>= 7
+    out.append(byte)
+    return bytes(out)
+
+def parse_pack_entry_header(buf, pos=0):
+    byte = buf[pos]
+    pos += 1
+    type_num = (byte >> 4) & 0x07
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+        byte = buf[pos]
+        pos += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    return type_num, size, pos
+
+class PackFile:
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-4] + ".pack"
+        with open(idx_path, "rb") as f:
+            idx = f.read()
+        if idx[:4] != PACK_IDX_SIGNATURE or struct.unpack_from(">I", idx, 4)[0] != PACK_VERSION:
+            raise Exception(f"Bad pack index {idx_path}")
+        self.fanout = struct.unpack_from(">256I", idx, 8)
+        self.count = self.fanout[255]
+        sha_start = 8 + 256 * 4
+        off_start = sha_start + 20 * self.count
+        self.shas = idx[sha_start:off_start]
+        self.offsets = struct.unpack_from(f">{self.count}Q", idx, off_start)
+        self._ends = None
+        self._file = None
+
+    def find(self, sha):
+        """
+        Return the pack offset of sha, or None if this pack doesn't hold it.
+        """
+        key = bytes.fromhex(sha)
+        first = key[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        shas = self.shas
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = shas[mid * 20:mid * 20 + 20]
+            if cur < key:
+                lo = mid + 1
+            elif cur > key:
+                hi = mid
+            else:
+                return self.offsets[mid]
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.shas[i * 20:i * 20 + 20].hex()
+
+    def _entry_end(self, offset):
+        # Entries are laid out back to back, so an entry ends where the next
+        # one (by offset) starts; the last one ends at the trailing checksum.
+        if self._ends is None:
+            ordered = sorted(self.offsets)
+            size = os.path.getsize(self.pack_path) - 20
+            self._ends = dict(zip(ordered, ordered[1:] + [size]))
+        return self._ends[offset]
+
+    def read_entry(self, offset):
+        """
+        Return (type_num, size, raw entry bytes after the header).
+        """
+        if self._file is None:
+            self._file = open(self.pack_path, "rb")
+        self._file.seek(offset)
+        raw = self._file.read(self._entry_end(offset) - offset)
+        type_num, size, pos = parse_pack_entry_header(raw)
+        return type_num, size, raw[pos:]
+
+    def header(self, offset):
+        """
+        Return (fmt, size) without inflating the object. A delta's size is in
+        the first bytes of its delta data; its type is that of the base, found
+        by following the chain through entry headers only.
+        """
+        if self._file is None:
+            self._file = open(self.pack_path, "rb")
+        size = None
+        while True:
+            self._file.seek(offset)
+            buf = self._file.read(32)
+            type_num, entry_size, pos = parse_pack_entry_header(buf)
+            if type_num != PACK_OFS_DELTA:
+                return PACK_TYPE_NAMES[type_num], entry_size if size is None else size
+            distance, pos = parse_ofs_delta_offset(buf, pos)
+            if size is None:
+                self._file.seek(offset + pos)
+                head = inflate_prefix(self._file, 20)
+                _, p = parse_delta_varint(head, 0)
+                size, _ = parse_delta_varint(head, p)
+            offset -= distance
+
+    def stream(self, offset, chunk_size=STREAM_CHUNK):
+        """
+        Return (fmt, size, chunks) like object_stream. Full entries are
+        inflated straight off a private file handle; deltas have to be
+        rebuilt in memory first, so those are just sliced.
+        """
+        if self._file is None:
+            self._file = open(self.pack_path, "rb")
+        self._file.seek(offset)
+        type_num, size, pos = parse_pack_entry_header(self._file.read(32))
+        if type_num == PACK_OFS_DELTA:
+            fmt, data = self.read(offset)
+            chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+            return fmt, len(data), chunks
+        f = open(self.pack_path, "rb")
+        f.seek(offset + pos)
+        return PACK_TYPE_NAMES[type_num], size, _closing(f, inflate_chunks(f, chunk_size))
+
+    def read(self, offset):
+        """
+        Return (fmt, data) for the entry at offset, applying deltas if needed.
+        The chain is walked iteratively down to the full base object.
+        """
+        deltas = []
+        while True:
+            type_num, size, raw = self.read_entry(offset)
+            if type_num != PACK_OFS_DELTA:
+                break
+            distance, pos = parse_ofs_delta_offset(raw)
+            deltas.append(zlib.decompress(raw[pos:]))
+            offset -= distance
+        data = zlib.decompress(raw)
+        if len(data) != size:
+            raise Exception(f"Corrupt pack entry at {offset} in {self.pack_path}")
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return PACK_TYPE_NAMES[type_num], data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def encode_ofs_delta_offset(distance):
+    # Big-endian base-128 where each continuation adds one, so no two
+    # encodings overlap (same scheme as Git).
+    out = [distance & 0x7f]
+    distance >>= 7
+    while distance:
+        distance -= 1
+        out.append(0x80 | (distance & 0x7f))
+        distance >>= 7
+    return bytes(reversed(out))
+
+def parse_ofs_delta_offset(buf, pos=0):
+    byte = buf[pos]
+    pos += 1
+    distance = byte & 0x7f
+    while byte & 0x80:
+        byte = buf[pos]
+        pos += 1
+        distance = ((distance + 1) << 7) | (byte & 0x7f)
+    return distance, pos
+
+# ----------------------
+# Deltas
+# ----------------------
+# A delta is: source size varint | target size varint | instructions...
+#   copy:   1xxxxxxx + up to 4 offset bytes + up to 3 size bytes; the low
+#           4 bits say which offset bytes follow, the next 3 which size bytes
+#   insert: 0nnnnnnn followed by n (1..127) literal bytes
+
+DELTA_BLOCK = 16
+DELTA_MAX_COPY = 0xffffff
+# A delta index holds at most this many blocks: bigger bases are sampled
+# every few blocks instead (a match found at a sampled block is extended
+# backwards, so little is lost). Each entry costs about
+# DELTA_INDEX_ENTRY_BYTES of memory.
+DELTA_INDEX_MAX_ENTRIES = 1 << 17
+DELTA_INDEX_ENTRY_BYTES = 100
+
+def delta_varint(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def parse_delta_varint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, pos
+
+def delta_index(base):
+    """
+    Map aligned DELTA_BLOCK-sized chunks of base to their first offset:
+    every chunk, or evenly spaced ones if there would be more than
+    DELTA_INDEX_MAX_ENTRIES.
+    """
+    blocks = len(base) // DELTA_BLOCK
+    stride = DELTA_BLOCK * -(-blocks // DELTA_INDEX_MAX_ENTRIES) if blocks else DELTA_BLOCK
+    index = {}
+    for i in range(0, len(base) - DELTA_BLOCK + 1, stride):
+        index.setdefault(base[i:i + DELTA_BLOCK], i)
+    return index
+
+def _delta_copy(out, offset, size):
+    while size:
+        n = min(size, DELTA_MAX_COPY)
+        cmd = 0x80
+        args = bytearray()
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xff
+            if byte:
+                cmd |= 1 << i
+                args.append(byte)
+        for i in range(3):
+            byte = (n >> (8 * i)) & 0xff
+            if byte:
+                cmd |= 0x10 << i
+                args.append(byte)
+        out.append(cmd)
+        out += args
+        offset += n
+        size -= n
+
+def _delta_insert(out, data):
+    for i in range(0, len(data), 127):
+        chunk = data[i:i + 127]
+        out.append(len(chunk))
+        out += chunk
+
+def create_delta(base, target, index=None, max_size=None):
+    """
+    Build a delta that turns base into target. Returns None if the delta
+    would be larger than max_size (so the caller stores the full object).
+    """
+    if index is None:
+        index = delta_index(base)
+    out = bytearray(delta_varint(len(base)) + delta_varint(len(target)))
+    pending = bytearray()
+    i = 0
+    n = len(target)
+    # Literal bytes still pending count too, so an unrelated base is given
+    # up on as soon as the delta can't fit
+    limit = max_size if max_size is not None else math.inf
+    while i < n:
+        b = index.get(target[i:i + DELTA_BLOCK]) if i + DELTA_BLOCK <= n else None
+        if b is None:
+            pending.append(target[i])
+            i += 1
+            if len(out) + len(pending) > limit:
+                return None
+            continue
+        # Extend the match forward, a block at a time first
+        length = DELTA_BLOCK
+        step = 4096
+        while step:
+            if base[b + length:b + length + step] == target[i + length:i + length + step] \
+                    and b + length + step <= len(base) and i + length + step <= n:
+                length += step
+            else:
+                step //= 2
+        # ...and backward into bytes we were about to insert literally
+        while pending and b > 0 and base[b - 1] == pending[-1]:
+            pending.pop()
+            b -= 1
+            i -= 1
+            length += 1
+        if pending:
+            _delta_insert(out, pending)
+            pending = bytearray()
+        _delta_copy(out, b, length)
+        i += length
+        if len(out) > limit:
+            return None
+    if pending:
+        _delta_insert(out, pending)
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def apply_delta(base, delta):
+    src_size, pos = parse_delta_varint(delta, 0)
+    dst_size, pos = parse_delta_varint(delta, pos)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch.")
+    out = bytearray()
+    n = len(delta)
+    while pos < n:
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            offset = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset + size]
+        elif cmd:
+            out += delta[pos:pos + cmd]
+            pos += cmd
+        else:
+            raise Exception("Invalid delta instruction.")
+    if len(out) != dst_size:
+        raise Exception("Delta result size mismatch.")
+    return bytes(out)
+
+def pack_order(repo, shas):
+    """
+    Sort objects so likely delta pairs sit next to each other: by type, then
+    by the path a blob was last seen at in any tree, then by size (largest
+    first, so bases are the bigger version).
+    """
+    info = {}
+    paths = {}
+    for sha in shas:
+        info[sha] = object_header(repo, sha)
+        if info[sha][0] == b'tree':
+            for mode, path, entry_sha in GitTree.deserialize(object_read_raw(repo, sha)[1]).entries:
+                paths[entry_sha] = path
+    return sorted(shas, key=lambda sha: (PACK_TYPES[info[sha][0]], paths.get(sha, ""), -info[sha][1], sha))
+
+def window_entry_bytes(data, index):
+    return len(data) + len(index) * DELTA_INDEX_ENTRY_BYTES
+
+def pack_write(repo, shas, window=PACK_WINDOW, depth=PACK_DEPTH, window_memory=PACK_WINDOW_MEMORY):
+    """
+    Write the given objects into a new pack + .idx and return the pack path.
+    Each object is tried as a delta against the previous `window` objects of
+    the same type, fewer if their data and delta indexes would take more
+    than window_memory bytes (0: no limit); chains never get longer than
+    `depth`.
+    """
+    os.makedirs(pack_dir(repo), exist_ok=True)
+    shas = sorted(set(shas))
+    tmp_path = os.path.join(pack_dir(repo), f"tmp_pack_{os.getpid()}")
+    checksum = hashlib.sha1()
+    offsets = {}
+    recent = []  # sliding window of (sha, fmt, data, delta index, depth)
+    recent_bytes = 0
+    with open(tmp_path, "wb") as f:
+        def emit(chunk):
+            checksum.update(chunk)
+            f.write(chunk)
+        emit(PACK_SIGNATURE + struct.pack(">II", PACK_VERSION, len(shas)))
+        offset = 12
+        for sha in pack_order(repo, shas) if window > 0 else shas:
+            fmt, data = object_read_raw(repo, sha)
+            best = None
+            for base_sha, base_fmt, base_data, base_index, base_depth in recent:
+                if base_fmt != fmt or base_depth >= depth:
+                    continue
+                # Only worth it if the delta is well under the full size
+                limit = len(data) // 2 if best is None else len(best[1]) - 1
+                if len(data) - len(base_data) > limit:
+                    continue  # the extra bytes alone would be inserted
+                delta = create_delta(base_data, data, base_index, limit)
+                if delta is not None:
+                    best = (base_sha, delta, base_depth + 1)
+            if best is not None:
+                base_sha, delta, obj_depth = best
+                entry = (pack_entry_header(PACK_OFS_DELTA, len(delta))
+                         + encode_ofs_delta_offset(offset - offsets[base_sha])
+                         + zlib.compress(delta))
+            else:
+                obj_depth = 0
+                entry = pack_entry_header(PACK_TYPES[fmt], len(data)) + zlib.compress(data)
+            offsets[sha] = offset
+            emit(entry)
+            offset += len(entry)
+            if window > 0:
+                index = delta_index(data)
+                recent.append((sha, fmt, data, index, obj_depth))
+                recent_bytes += window_entry_bytes(data, index)
+                # The newest entry always stays, however big it is
+                while len(recent) > window or (window_memory and recent_bytes > window_memory and len(recent) > 1):
+                    old = recent.pop(0)
+                    recent_bytes -= window_entry_bytes(old[2], old[3])
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+    name = "pack-" + pack_sha.hex()
+    pack_path = os.path.join(pack_dir(repo), name + ".pack")
+    os.replace(tmp_path, pack_path)
+    pack_write_index(repo, name, offsets, pack_sha)
+    return pack_path
+
+def pack_write_index(repo, name, offsets, pack_sha, fsync=False):
+    """
+    Write the .idx for pack `name` from a {sha: offset} dict.
+    """
+    shas = sorted(offsets)
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    idx = bytearray(PACK_IDX_SIGNATURE + struct.pack(">I", PACK_VERSION))
+    idx += struct.pack(">256I", *fanout)
+    idx += b''.join(bytes.fromhex(sha) for sha in shas)
+    idx += struct.pack(f">{len(shas)}Q", *(offsets[sha] for sha in shas))
+    idx += pack_sha
+    idx += hashlib.sha1(idx).digest()
+    idx_tmp = os.path.join(pack_dir(repo), f"tmp_idx_{os.getpid()}")
+    with open(idx_tmp, "wb") as f:
+        f.write(idx)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    # The .idx goes in last: readers discover packs through it
+    os.replace(idx_tmp, os.path.join(pack_dir(repo), name + ".idx"))
+
+# ----------------------
+# Batched Writes
+# ----------------------
+
+# fsync policy for ObjectWriter: "none", "batch" (everything once, at
+# commit) or "every-object". Set with core.fsync in the config, or
+# MINIGIT_FSYNC, which takes precedence.
+FSYNC_POLICIES = ("none", "batch", "every-object")
+FSYNC_POLICY = os.environ.get("MINIGIT_FSYNC")
+
+class ObjectWriter:
+    """
+    Transaction for bulk object writes (add, commit, imports).
+
+        with ObjectWriter(repo, pack=True) as writer:
+            writer.write_file(path)
+            writer.write(tree, "tree")
+
+    Compared with calling object_write in a loop: each fanout directory is
+    listed/created at most once instead of an exists()+makedirs() per object,
+    SHAs seen in this transaction are deduped in memory, objects can go
+    straight into one new pack, and fsync follows a single policy.
+    """
+    def __init__(self, repo, pack=False, fsync=None):
+        self.repo = repo
+        self.pack = pack
+        self.fsync = fsync or FSYNC_POLICY or repo_config(repo).get("core", "fsync")
+        if self.fsync not in FSYNC_POLICIES:
+            raise Exception(f"Unknown fsync policy: {self.fsync}")
+        self.objects_dir = os.path.join(repo.gitdir, "objects")
+        self.written = set()
+        self._fanout = None      # prefix -> set of loose names, listed lazily
+        self._pending = []       # loose files waiting for a batch fsync
+        self._pack_file = None
+        self._pack_tmp = None
+        self._pack_offsets = {}  # sha -> offset in the pack being written
+
+    def __enter__(self):
+        if self.pack:
+            os.makedirs(pack_dir(self.repo), exist_ok=True)
+            fd, self._pack_tmp = tempfile.mkstemp(prefix="tmp_pack_", dir=pack_dir(self.repo))
+            self._pack_file = os.fdopen(fd, "w+b")
+            # Object count is patched in at commit time
+            self._pack_file.write(PACK_SIGNATURE + struct.pack(">II", PACK_VERSION, 0))
+        else:
+            # One listing tells us which fanout directories already exist
+            self._fanout = {d: None for d in os.listdir(self.objects_dir) if len(d) == 2}
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+    def _known(self, sha):
+        if sha in self.written:
+            return True
+        for pack in repo_packs(self.repo):
+            if pack.find(sha) is not None:
+                return True
+        if self._fanout is not None:
+            prefix = sha[:2]
+            if prefix not in self._fanout:
+                return False
+            if self._fanout[prefix] is None:
+                self._fanout[prefix] = set(os.listdir(os.path.join(self.objects_dir, prefix)))
+            return sha[2:] in self._fanout[prefix]
+        return False
+
+    def _loose_dir(self, sha):
+        prefix = sha[:2]
+        d = os.path.join(self.objects_dir, prefix)
+        if prefix not in self._fanout:
+            os.makedirs(d, exist_ok=True)
+            self._fanout[prefix] = set()
+        return d
+
+    def _synced(self, f, path=None):
+        if self.fsync == "every-object":
+            f.flush()
+            os.fsync(f.fileno())
+        elif self.fsync == "batch" and path is not None:
+            self._pending.append(path)
+
+    def write(self, obj, fmt):
+        data = obj.serialize()
+        header = f"{fmt} {len(data)}".encode() + b'\x00'
+        sha = hashlib.sha1(header + data).hexdigest()
+        if self._known(sha):
+            return sha
+        if self.pack:
+            f = self._pack_file
+            self._pack_offsets[sha] = f.tell()
+            f.write(pack_entry_header(PACK_TYPES[fmt.encode()], len(data)) + zlib.compress(data))
+            self._synced(f)
+        else:
+            path = os.path.join(self._loose_dir(sha), sha[2:])
+            with open(path, "wb") as f:
+                f.write(zlib.compress(header + data))
+                self._synced(f, path)
+            self._fanout[sha[:2]].add(sha[2:])
+        self.written.add(sha)
+        return sha
+
+    def write_file(self, path, fmt="blob"):
+        """
+        Stream a file in with constant memory, like object_write_file.
+        """
+        with open(path, "rb") as src:
+            size = os.fstat(src.fileno()).st_size
+            header = f"{fmt} {size}".encode() + b'\x00'
+            if self.pack:
+                f = self._pack_file
+                offset = f.tell()
+                f.write(pack_entry_header(PACK_TYPES[fmt.encode()], size))
+                sha, total = deflate_stream(src, f, header, include_header=False)
+                if total != size:
+                    raise Exception(f"{path} changed while it was being hashed.")
+                if self._known(sha):
+                    # Already stored: drop the entry we just appended
+                    f.seek(offset)
+                    f.truncate()
+                    return sha
+                self._pack_offsets[sha] = offset
+                self._synced(f)
+            else:
+                fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=self.objects_dir)
+                try:
+                    with os.fdopen(fd, "wb") as dst:
+                        sha, total = deflate_stream(src, dst, header)
+                        if total != size:
+                            raise Exception(f"{path} changed while it was being hashed.")
+                        if not self._known(sha):
+                            self._synced(dst)
+                    if self._known(sha):
+                        os.remove(tmp_path)
+                        return sha
+                    obj_path = os.path.join(self._loose_dir(sha), sha[2:])
+                    os.replace(tmp_path, obj_path)
+                    if self.fsync == "batch":
+                        self._pending.append(obj_path)
+                    self._fanout[sha[:2]].add(sha[2:])
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+        self.written.add(sha)
+        return sha
+
+    def adopt(self, sha, size, tmp_path, fmt="blob"):
+        """
+        Take over an object a worker already compressed into tmp_path (see
+        deflate_to_temp): renamed into place when loose, copied into the
+        pack as-is (no recompression) when packing.
+        """
+        if self._known(sha):
+            os.remove(tmp_path)
+            return sha
+        if self.pack:
+            f = self._pack_file
+            self._pack_offsets[sha] = f.tell()
+            f.write(pack_entry_header(PACK_TYPES[fmt.encode()], size))
+            with open(tmp_path, "rb") as src:
+                shutil.copyfileobj(src, f, STREAM_CHUNK)
+            os.remove(tmp_path)
+            self._synced(f)
+        else:
+            obj_path = os.path.join(self._loose_dir(sha), sha[2:])
+            if self.fsync == "every-object":
+                fd = os.open(tmp_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            os.replace(tmp_path, obj_path)
+            if self.fsync == "batch":
+                self._pending.append(obj_path)
+            self._fanout[sha[:2]].add(sha[2:])
+        self.written.add(sha)
+        return sha
+
+    def write_files(self, paths, jobs=1):
+        """
+        Store many files, yielding their SHAs in the order given. With jobs > 1
+        hashing and compression run in a process pool; at most a few tasks per
+        worker are in flight, so memory and temp files stay bounded.
+        """
+        if jobs <= 1:
+            for path in paths:
+                yield self.write_file(path)
+            return
+        tmp_dir = pack_dir(self.repo) if self.pack else self.objects_dir
+        # Files go to workers in small batches: one task per file would
+        # spend more time pickling than hashing for typical source files
+        batches = [paths[i:i + PARALLEL_BATCH] for i in range(0, len(paths), PARALLEL_BATCH)]
+        in_flight = deque()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            try:
+                for batch in batches:
+                    in_flight.append(pool.submit(deflate_batch_to_temp, tmp_dir, batch, "blob", not self.pack))
+                    if len(in_flight) >= jobs * 4:
+                        for result in in_flight.popleft().result():
+                            yield self.adopt(*result)
+                while in_flight:
+                    for result in in_flight.popleft().result():
+                        yield self.adopt(*result)
+            finally:
+                # On error, clean up whatever the remaining workers produced
+                for future in in_flight:
+                    try:
+                        results = future.result()
+                    except Exception:
+                        continue
+                    for _, _, tmp_path in results:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+
+    def commit(self):
+        if self.pack:
+            self._finish_pack()
+        if self.fsync != "none":
+            dirs = set()
+            for path in self._pending:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                dirs.add(os.path.dirname(path))
+            for d in dirs:
+                fd = os.open(d, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        self._pending = []
+
+    def _finish_pack(self):
+        f = self._pack_file
+        self._pack_file = None
+        if not self._pack_offsets:
+            f.close()
+            os.remove(self._pack_tmp)
+            return
+        f.seek(8)
+        f.write(struct.pack(">I", len(self._pack_offsets)))
+        # The checksum covers the patched header, so hash the file once more
+        f.seek(0)
+        checksum = hashlib.sha1()
+        for chunk in iter(lambda: f.read(STREAM_CHUNK), b''):
+            checksum.update(chunk)
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+        if self.fsync != "none":
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+        name = "pack-" + pack_sha.hex()
+        os.replace(self._pack_tmp, os.path.join(pack_dir(self.repo), name + ".pack"))
+        pack_write_index(self.repo, name, self._pack_offsets, pack_sha, fsync=self.fsync != "none")
+        # Make the new pack visible to readers of this repository object
+        self.repo.packs = None
+
+    def abort(self):
+        if self._pack_file is not None:
+            self._pack_file.close()
+            self._pack_file = None
+            os.remove(self._pack_tmp)
+        self._pending = []
+
+# ----------------------
+# Diff
+# ----------------------
+# A diff is a list of Change records in path order. Three sources:
+#   diff_trees           tree vs tree; subtrees with equal SHAs are skipped
+#   diff_index_tree      tree (HEAD) vs index; directories whose cache-tree
+#                        SHA equals the tree's are skipped
+#   diff_index_worktree  index vs files on disk, via stat data/fsmonitor
+# so the cost follows the size of the change, not of the repository.
+
+class Change:
+    """
+    One changed path. status is "A", "D" or "M"; old/new are (mode, sha) or
+    None for the side where the path doesn't exist. in_worktree means the
+    new side is the file on disk (its sha is not in the object store).
+    """
+    __slots__ = ("status", "path", "old", "new", "in_worktree")
+
+    def __init__(self, status, path, old, new, in_worktree=False):
+        self.status = status
+        self.path = path
+        self.old = old
+        self.new = new
+        self.in_worktree = in_worktree
+
+def tree_entry_key(entry):
+    # Trees sort a subdirectory as if its name ended in "/"
+    mode, name, sha = entry
+    return name + "/" if mode == "040000" else name
+
+def sorted_tree_entries(repo, tree_sha):
+    if not tree_sha:
+        return []
+    # Linear for trees we write (already in order); also puts trees from
+    # older versions in order
+    return sorted(object_read(repo, tree_sha).entries, key=tree_entry_key)
+
+def diff_trees(repo, old_tree, new_tree, prefix=""):
+    """
+    Return the Changes turning tree old_tree into new_tree (either may be
+    None). Entries are merged in one pass over both sorted lists, and a
+    subtree present on both sides with the same SHA is not read at all.
+    """
+    if old_tree == new_tree:
+        return []
+    old = sorted_tree_entries(repo, old_tree)
+    new = sorted_tree_entries(repo, new_tree)
+    if is_flat_tree(old) or is_flat_tree(new):
+        old = tree_file_entries(repo, old_tree, prefix) if old_tree else {}
+        new = tree_file_entries(repo, new_tree, prefix) if new_tree else {}
+        return diff_file_maps(old, new)
+    changes = []
+    i = j = 0
+    while i < len(old) or j < len(new):
+        a = old[i] if i < len(old) else None
+        b = new[j] if j < len(new) else None
+        if b is None or (a is not None and tree_entry_key(a) < tree_entry_key(b)):
+            b = None
+            i += 1
+        elif a is None or tree_entry_key(b) < tree_entry_key(a):
+            a = None
+            j += 1
+        else:
+            i += 1
+            j += 1
+            if a[0] == b[0] and a[2] == b[2]:
+                continue
+        path = prefix + (a or b)[1]
+        if (a or b)[0] == "040000":
+            changes.extend(diff_trees(repo, a and a[2], b and b[2], path + "/"))
+        elif a is None:
+            changes.append(Change("A", path, None, (b[0], b[2])))
+        elif b is None:
+            changes.append(Change("D", path, (a[0], a[2]), None))
+        else:
+            changes.append(Change("M", path, (a[0], a[2]), (b[0], b[2])))
+    return changes
+
+def diff_file_maps(old, new):
+    """
+    Changes between two {path: (mode, sha)} maps, in path order.
+    """
+    changes = []
+    for path in sorted(old.keys() | new.keys()):
+        a, b = old.get(path), new.get(path)
+        if a == b:
+            continue
+        changes.append(Change("A" if a is None else "D" if b is None else "M", path, a, b))
+    return changes
+
+def diff_index_tree(repo, index, tree_sha):
+    """
+    Return the Changes from tree tree_sha (usually HEAD's) to the index,
+    i.e. what committing would record. A directory whose cache-tree entry
+    (see write_tree) matches the tree's subtree is skipped without looking
+    at its index entries.
+    """
+    paths = sorted(index)
+    cache_tree = index.cache_tree
+    changes = []
+
+    def walk(lo, hi, prefix, tree_sha):
+        cached = cache_tree.get(prefix)
+        if tree_sha and cached is not None and cached == (hi - lo, tree_sha):
+            return
+        # This directory's index side: (key, name, IndexEntry or (lo, hi))
+        entries = []
+        i = lo
+        while i < hi:
+            rest = paths[i][len(prefix):]
+            slash = rest.find(os.sep)
+            if slash < 0:
+                entries.append((rest, rest, index[paths[i]]))
+                i += 1
+                continue
+            name = rest[:slash]
+            j = bisect.bisect_left(paths, prefix + name + chr(ord(os.sep) + 1), i, hi)
+            entries.append((name + "/", name, (i, j)))
+            i = j
+        old = sorted_tree_entries(repo, tree_sha)
+        if is_flat_tree(old):
+            current = {paths[k]: (tree_mode(index[paths[k]]), index[paths[k]].sha) for k in range(lo, hi)}
+            changes.extend(diff_file_maps(tree_file_entries(repo, tree_sha, prefix), current))
+            return
+        i = j = 0
+        while i < len(old) or j < len(entries):
+            a = old[i] if i < len(old) else None
+            b = entries[j] if j < len(entries) else None
+            if b is None or (a is not None and tree_entry_key(a) < b[0]):
+                b = None
+                i += 1
+            elif a is None or b[0] < tree_entry_key(a):
+                a = None
+                j += 1
+            else:
+                i += 1
+                j += 1
+            path = prefix + (a or b)[1]
+            if a is not None and a[0] == "040000":
+                if b is not None and isinstance(b[2], tuple):
+                    walk(b[2][0], b[2][1], path + os.sep, a[2])
+                    continue
+                changes.extend(diff_trees(repo, a[2], None, path + "/"))
+                a = None
+            if b is not None and isinstance(b[2], tuple):
+                walk(b[2][0], b[2][1], path + os.sep, None)
+                b = None
+            new = (tree_mode(b[2]), b[2].sha) if b is not None else None
+            old_entry = (a[0], a[2]) if a is not None else None
+            if new == old_entry:
+                continue
+            if old_entry is None:
+                changes.append(Change("A", path, None, new))
+            elif new is None:
+                changes.append(Change("D", path, old_entry, None))
+            else:
+                changes.append(Change("M", path, old_entry, new))
+
+    walk(0, len(paths), "", tree_sha)
+    changes.sort(key=lambda change: change.path)
+    return changes
+
+def diff_index_worktree(repo, index, racy_ns):
+    """
+    Return (changes, refreshed): Changes from the index to the files on
+    disk, and whether index entries were updated along the way. Entries the
+    fsmonitor vouches for are skipped, and only files whose stat data
+    changed (or is racy) are rehashed; if the content turns out the same,
+    the entry's stat data is refreshed so it is skipped next time.
+    """
+    monitored = index.fsmonitor_token is not None
+    changes = []
+    refreshed = False
+    for path, entry in sorted(index.items()):
+        if monitored and entry.flags & ENTRY_FSMONITOR_VALID:
+            continue  # the daemon saw no change since it was verified
+        old = (tree_mode(entry), entry.sha)
+        try:
+            st = os.stat(os.path.join(repo.worktree, path))
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            # Gone, or replaced by a directory or something else unhashable
+            changes.append(Change("D", path, old, None))
+            continue
+        if not stat_matches(entry, st, racy_ns):
+            new = IndexEntry.from_stat(hash_file(os.path.join(repo.worktree, path)), st)
+            if (tree_mode(new), new.sha) != old:
+                changes.append(Change("M", path, old, (tree_mode(new), new.sha), in_worktree=True))
+                continue
+            # Same content: cache the new stat data so we skip it next time
+            entry = index[path] = new
+            refreshed = True
+        if monitored:
+            entry.flags |= ENTRY_FSMONITOR_VALID
+            refreshed = True
+    return changes, refreshed
+
+def diff_tree_worktree(repo, index, tree_sha, racy_ns):
+    """
+    Return (changes, refreshed): Changes from tree tree_sha to the files on
+    disk, for the paths in the tree or the index (untracked files are left
+    out), as diff_index_tree followed by diff_index_worktree.
+    """
+    staged = {change.path: change for change in diff_index_tree(repo, index, tree_sha)}
+    unstaged, refreshed = diff_index_worktree(repo, index, racy_ns)
+    changes = {}
+    for change in unstaged:
+        before = staged.pop(change.path, None)
+        old = before.old if before is not None else change.old
+        if old == change.new or (old is None and change.new is None):
+            continue  # changed in the index and changed back on disk
+        status = "A" if old is None else "D" if change.new is None else "M"
+        changes[change.path] = Change(status, change.path, old, change.new, change.in_worktree)
+    changes.update(staged)
+    return [changes[path] for path in sorted(changes)], refreshed
+
+def change_data(repo, change, side):
+    """
+    Content of the old or new side of a change, b'' where it doesn't exist.
+    """
+    mode_sha = change.old if side == "old" else change.new
+    if mode_sha is None:
+        return b''
+    if side == "new" and change.in_worktree:
+        with open(os.path.join(repo.worktree, change.path), "rb") as f:
+            return f.read()
+    return object_read(repo, mode_sha[1]).data
+
+def is_binary(data):
+    return b'\x00' in data[:8000]
+
+def diff_lines(a, b, algorithm="histogram"):
+    """
+    Opcodes (tag, i1, i2, j1, j2) turning line list a into b, as in difflib.
+    algorithm is "histogram" (anchors on rare lines; reads better on moved
+    blocks and is faster on large files) or "myers" (a minimal diff).
+    See the Line Diff section.
+    """
+    if algorithm not in LINE_DIFF_ALGORITHMS:
+        raise Exception(f"Unknown diff algorithm: {algorithm}")
+    a_ids, b_ids = intern_lines(a, b)
+    matches = []
+    # Common prefix and suffix never reach the core algorithm
+    lo = 0
+    hi_a, hi_b = len(a_ids), len(b_ids)
+    while lo < hi_a and lo < hi_b and a_ids[lo] == b_ids[lo]:
+        lo += 1
+    while hi_a > lo and hi_b > lo and a_ids[hi_a - 1] == b_ids[hi_b - 1]:
+        hi_a -= 1
+        hi_b -= 1
+    if lo:
+        matches.append((0, 0, lo))
+    if algorithm == "histogram":
+        histogram_matches(a_ids, b_ids, lo, hi_a, lo, hi_b, matches)
+    else:
+        myers_matches(a_ids, b_ids, lo, hi_a, lo, hi_b, matches)
+    if hi_a < len(a_ids):
+        matches.append((hi_a, hi_b, len(a_ids) - hi_a))
+    return matches_to_opcodes(sorted(matches), len(a_ids), len(b_ids))
+
+def group_hunks(opcodes, context=3):
+    """
+    Split opcodes into hunks with `context` equal lines around each change.
+    """
+    codes = list(opcodes)
+    if not codes:
+        return
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == "equal":
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == "equal":
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    hunk = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * context:
+            hunk.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield hunk
+            hunk = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        hunk.append((tag, i1, i2, j1, j2))
+    if hunk and not (len(hunk) == 1 and hunk[0][0] == "equal"):
+        yield hunk
+
+def hunk_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1 if length else start},{length}"
+
+def format_patch(repo, change, context=3, algorithm="histogram"):
+    """
+    Return the Git-style unified patch for one change as a string.
+    """
+    old_path = f"a/{change.path}" if change.old else "/dev/null"
+    new_path = f"b/{change.path}" if change.new else "/dev/null"
+    out = [f"diff --git a/{change.path} b/{change.path}"]
+    if change.old is None:
+        out.append(f"new file mode {change.new[0]}")
+    elif change.new is None:
+        out.append(f"deleted file mode {change.old[0]}")
+    elif change.old[0] != change.new[0]:
+        out.append(f"old mode {change.old[0]}")
+        out.append(f"new mode {change.new[0]}")
+    old_sha = change.old[1][:7] if change.old else "0000000"
+    new_sha = change.new[1][:7] if change.new else "0000000"
+    same_mode = change.old and change.new and change.old[0] == change.new[0]
+    out.append(f"index {old_sha}..{new_sha}" + (f" {change.old[0]}" if same_mode else ""))
+    a_data = change_data(repo, change, "old")
+    b_data = change_data(repo, change, "new")
+    if is_binary(a_data) or is_binary(b_data):
+        out.append(f"Binary files {old_path} and {new_path} differ")
+        return "\n".join(out) + "\n"
+    a = a_data.splitlines(keepends=True)
+    b = b_data.splitlines(keepends=True)
+    hunks = list(group_hunks(diff_lines(a, b, algorithm), context))
+    if hunks:
+        out.append(f"--- {old_path}")
+        out.append(f"+++ {new_path}")
+    for hunk in hunks:
+        out.append(f"@@ -{hunk_range(hunk[0][1], hunk[-1][2])} +{hunk_range(hunk[0][3], hunk[-1][4])} @@")
+        for tag, i1, i2, j1, j2 in hunk:
+            if tag == "equal":
+                out.extend(patch_lines(" ", a[i1:i2]))
+                continue
+            out.extend(patch_lines("-", a[i1:i2]))
+            out.extend(patch_lines("+", b[j1:j2]))
+    return "\n".join(out) + "\n"
+
+def patch_lines(sign, lines):
+    for line in lines:
+        text = line.decode("utf-8", "replace")
+        if text.endswith("\n"):
+            yield sign + text[:-1]
+        else:
+            yield sign + text
+            yield "\\ No newline at end of file"
+
+def change_line_counts(repo, change, algorithm="histogram"):
+    """
+    Return (insertions, deletions), or None for binary files.
+    """
+    a_data = change_data(repo, change, "old")
+    b_data = change_data(repo, change, "new")
+    if is_binary(a_data) or is_binary(b_data):
+        return None
+    a = a_data.splitlines(keepends=True)
+    b = b_data.splitlines(keepends=True)
+    added = deleted = 0
+    for tag, i1, i2, j1, j2 in diff_lines(a, b, algorithm):
+        if tag != "equal":
+            deleted += i2 - i1
+            added += j2 - j1
+    return added, deleted
+
+def format_stat(repo, changes, width=60, algorithm="histogram"):
+    """
+    Return a diffstat: one " path | n +++--" line per change and a summary.
+    """
+    counts = [change_line_counts(repo, change, algorithm) for change in changes]
+    name_width = max((len(change.path) for change in changes), default=0)
+    most = max((a + d for c in counts if c for a, d in [c]), default=0)
+    num_width = len(str(most))
+    bar_width = max(1, width - name_width - num_width - 4)
+    out = []
+    insertions = deletions = 0
+    for change, count in zip(changes, counts):
+        if count is None:
+            out.append(f" {change.path:<{name_width}} | Bin")
+            continue
+        added, deleted = count
+        insertions += added
+        deletions += deleted
+        if most > bar_width:
+            # Scale the bar, keeping at least one sign for a nonzero count
+            added = max(added * bar_width // most, 1 if added else 0)
+            deleted = max(deleted * bar_width // most, 1 if deleted else 0)
+        out.append(f" {change.path:<{name_width}} | {sum(count):>{num_width}} {'+' * added}{'-' * deleted}".rstrip())
+    files = len(changes)
+    summary = f" {files} file{'s' if files != 1 else ''} changed"
+    if insertions:
+        summary += f", {insertions} insertion{'s' if insertions != 1 else ''}(+)"
+    if deletions:
+        summary += f", {deletions} deletion{'s' if deletions != 1 else ''}(-)"
+    out.append(summary)
+    return "\n".join(out) + "\n"
+
+# ----------------------
+# Line Diff
+# ----------------------
+# Lines are interned to small ints first, so the algorithms compare ints
+# rather than byte strings, and each subproblem has its common prefix and
+# suffix trimmed before any real work.
+#
+# myers: Myers' O(ND) algorithm with the linear-space refinement: find a
+# point on the shortest edit script by running the search forwards from
+# the start and backwards from the end until they meet, then solve both
+# halves the same way. Subproblems are ranges of the same two lists and
+# share one pair of O(N + M) diagonal arrays. Two heuristics trade
+# minimality for bounded time on large, very different inputs:
+#   - as in Git, lines the other side doesn't have can never match and are
+#     left out of the search, and so are lines the other side has more
+#     than sqrt(N) times when they sit between such lines (boilerplate in
+#     rewritten code);
+#   - a search that runs past max(MYERS_MIN_COST, sqrt(N + M)) edits is
+#     abandoned, and the range is split at the lines that occur once on
+#     each side instead (the longest run of them in the same order, as in
+#     patience diff), or is all deleted and inserted if there are none.
+#     A moved block then costs what it should, and unrelated files cost
+#     O((N + M) * cost) rather than O(N * M).
+#
+# histogram: as in Git, pick the line of b that occurs least often in a
+# (at most HISTOGRAM_MAX_CHAIN times), extend it to the longest common run
+# around it, and recurse on both sides. Ranges with no usable anchor fall
+# back to myers. This is the default: it is usually the faster of the two
+# here and keeps moved blocks together.
+
+LINE_DIFF_ALGORITHMS = ("myers", "histogram")
+MYERS_MIN_COST = 256
+HISTOGRAM_MAX_CHAIN = 64
+
+def intern_lines(a, b):
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    return a_ids, b_ids
+
+def trim_common(a, b, a0, a1, b0, b1, matches):
+    """
+    Record the common prefix and suffix of a[a0:a1] and b[b0:b1] as matches
+    and return the bounds of what's left.
+    """
+    start_a, start_b = a0, b0
+    while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+        a0 += 1
+        b0 += 1
+    if a0 > start_a:
+        matches.append((start_a, start_b, a0 - start_a))
+    end_a = a1
+    while a1 > a0 and b1 > b0 and a[a1 - 1] == b[b1 - 1]:
+        a1 -= 1
+        b1 -= 1
+    if a1 < end_a:
+        matches.append((a1, b1, end_a - a1))
+    return a0, a1, b0, b1
+
+def split_point(a, b, x0, x1, y0, y1, vf, vb, max_cost):
+    """
+    Return a point (x, y) that a shortest edit script from a[x0:x1] to
+    b[y0:y1] passes through, or None if finding one costs more than
+    max_cost edits (see Line Diff). The ranges must be non-empty and
+    differ at both ends (see trim_common). vf and vb are scratch arrays
+    of len(a) + len(b) + 3 entries, shared by all calls.
+    """
+    # Diagonals are numbered k = x - y over the whole of a and b, so no
+    # subproblem is copied; vf[k] is the furthest x reached on diagonal k
+    # going forwards from (x0, y0), vb[k] the lowest going backwards from
+    # (x1, y1). Negative k wrap around.
+    kmin, kmax = x0 - y1, x1 - y0
+    fmid, bmid = x0 - y0, x1 - y1
+    odd = (fmid - bmid) & 1
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    vf[fmid] = x0
+    vb[bmid] = x1
+    for cost in range(1, max_cost + 1):
+        # Widen each search by a diagonal at both ends, staying inside the
+        # box; the sentinels make the edge diagonals extend inwards
+        if fmin > kmin:
+            fmin -= 1
+            vf[fmin - 1] = -1
+        else:
+            fmin += 1
+        if fmax < kmax:
+            fmax += 1
+            vf[fmax + 1] = -1
+        else:
+            fmax -= 1
+        for k in range(fmax, fmin - 1, -2):
+            x = vf[k - 1] + 1 if vf[k - 1] >= vf[k + 1] else vf[k + 1]
+            y = x - k
+            while x < x1 and y < y1 and a[x] == b[y]:
+                x += 1
+                y += 1
+            vf[k] = x
+            if odd and bmin <= k <= bmax and vb[k] <= x:
+                return x, y
+        if bmin > kmin:
+            bmin -= 1
+            vb[bmin - 1] = x1 + 1
+        else:
+            bmin += 1
+        if bmax < kmax:
+            bmax += 1
+            vb[bmax + 1] = x1 + 1
+        else:
+            bmax -= 1
+        for k in range(bmax, bmin - 1, -2):
+            x = vb[k - 1] if vb[k - 1] < vb[k + 1] else vb[k + 1] - 1
+            y = x - k
+            while x > x0 and y > y0 and a[x - 1] == b[y - 1]:
+                x -= 1
+                y -= 1
+            vb[k] = x
+            if not odd and fmin <= k <= fmax and x <= vf[k]:
+                return x, y
+    return None
+
+def unique_anchors(a, b, x0, x1, y0, y1):
+    """
+    Return the longest increasing run of (i, j) with a[i] == b[j] among the
+    lines that occur exactly once in both a[x0:x1] and b[y0:y1].
+    """
+    counts = {}
+    for i in range(x0, x1):
+        counts[a[i]] = counts.get(a[i], 0) + 1
+    where = {}
+    for j in range(y0, y1):
+        if counts.get(b[j]) == 1:
+            where[b[j]] = None if b[j] in where else j
+    pairs = [(i, where[a[i]]) for i in range(x0, x1) if counts[a[i]] == 1 and where.get(a[i]) is not None]
+    # Patience sorting: tails[p] is the smallest j ending a run of p + 1
+    tails = []
+    ends = []
+    links = []
+    for pos, (i, j) in enumerate(pairs):
+        p = bisect.bisect_left(tails, j)
+        if p == len(tails):
+            tails.append(j)
+            ends.append(pos)
+        else:
+            tails[p] = j
+            ends[p] = pos
+        links.append(ends[p - 1] if p else None)
+    run = []
+    pos = ends[-1] if ends else None
+    while pos is not None:
+        run.append(pairs[pos])
+        pos = links[pos]
+    run.reverse()
+    return run
+
+def discard_lines(a, b, a0, a1, b0, b1):
+    """
+    Return the indexes of a[a0:a1] worth searching for matches in
+    b[b0:b1]: see the first heuristic in Line Diff.
+    """
+    counts = {}
+    for j in range(b0, b1):
+        counts[b[j]] = counts.get(b[j], 0) + 1
+    limit = max(HISTOGRAM_MAX_CHAIN, math.isqrt(a1 - a0))
+    # 0: keep, 1: no match at all, 2: too common to be worth it on its own
+    kind = [0 if 0 < counts.get(a[i], 0) <= limit else 1 if a[i] not in counts else 2 for i in range(a0, a1)]
+    keep = []
+    prev = 1  # the start of the range counts as a discarded line
+    for pos, k in enumerate(kind):
+        if k == 2:
+            nxt = pos + 1
+            while nxt < len(kind) and kind[nxt] == 2:
+                nxt += 1
+            following = kind[nxt] if nxt < len(kind) else 1
+            if prev == 1 and following == 1:
+                continue
+        elif k == 1:
+            prev = 1
+            continue
+        else:
+            prev = 0
+        keep.append(a0 + pos)
+    return keep
+
+def myers_matches(a, b, a0, a1, b0, b1, matches):
+    """
+    Append the (i, j, length) common runs of a diff of a[a0:a1] and
+    b[b0:b1] to matches (minimal unless a heuristic kicks in).
+    """
+    a0, a1, b0, b1 = trim_common(a, b, a0, a1, b0, b1, matches)
+    if a0 == a1 or b0 == b1:
+        return
+    # Search only the lines worth searching, then map back
+    keep_a = discard_lines(a, b, a0, a1, b0, b1)
+    keep_b = discard_lines(b, a, b0, b1, a0, a1)
+    ka = [a[i] for i in keep_a]
+    kb = [b[j] for j in keep_b]
+    n, m = len(ka), len(kb)
+    vf = [0] * (n + m + 3)
+    vb = [0] * (n + m + 3)
+    max_cost = max(MYERS_MIN_COST, math.isqrt(n + m))
+    found = []
+    stack = [(0, n, 0, m)]
+    while stack:
+        x0, x1, y0, y1 = trim_common(ka, kb, *stack.pop(), found)
+        if x0 == x1 or y0 == y1:
+            continue  # only insertions or only deletions left
+        point = split_point(ka, kb, x0, x1, y0, y1, vf, vb, max_cost)
+        if point is not None:
+            x, y = point
+            stack.append((x0, x, y0, y))
+            stack.append((x, x1, y, y1))
+            continue
+        # Too costly to stay minimal: match the lines unique to both sides
+        # and diff the gaps between them. Without any, the whole range is
+        # a delete and an insert.
+        x, y = x0, y0
+        for i, j in unique_anchors(ka, kb, x0, x1, y0, y1):
+            found.append((i, j, 1))
+            stack.append((x, i, y, j))
+            x, y = i + 1, j + 1
+        if x > x0:
+            stack.append((x, x1, y, y1))
+    found.sort()
+    for i, j, length in found:
+        for k in range(length):
+            matches.append((keep_a[i + k], keep_b[j + k], 1))
+
+def histogram_matches(a, b, a0, a1, b0, b1, matches):
+    """
+    Like myers_matches, anchoring on the rarest lines (see Line Diff).
+    """
+    stack = [(a0, a1, b0, b1)]
+    while stack:
+        a0, a1, b0, b1 = stack.pop()
+        a0, a1, b0, b1 = trim_common(a, b, a0, a1, b0, b1, matches)
+        if a0 == a1 or b0 == b1:
+            continue
+        where = {}
+        for i in range(a0, a1):
+            where.setdefault(a[i], []).append(i)
+        best = None  # (occurrences, -length, i, j)
+        j = b0
+        while j < b1:
+            occurrences = where.get(b[j])
+            if not occurrences or len(occurrences) > HISTOGRAM_MAX_CHAIN or (best and len(occurrences) > best[0]):
+                j += 1
+                continue
+            next_j = j + 1
+            for i in occurrences:
+                si, sj = i, j
+                while si > a0 and sj > b0 and a[si - 1] == b[sj - 1]:
+                    si -= 1
+                    sj -= 1
+                ei, ej = i + 1, j + 1
+                while ei < a1 and ej < b1 and a[ei] == b[ej]:
+                    ei += 1
+                    ej += 1
+                candidate = (len(occurrences), si - ei, si, sj)
+                if best is None or candidate < best:
+                    best = candidate
+                # Lines of b inside this run can't anchor a longer one
+                next_j = max(next_j, ej)
+            j = next_j
+        if best is None:
+            myers_matches(a, b, a0, a1, b0, b1, matches)
+            continue
+        _, neg_length, si, sj = best
+        ei, ej = si - neg_length, sj - neg_length
+        matches.append((si, sj, ei - si))
+        stack.append((a0, si, b0, sj))
+        stack.append((ei, a1, ej, b1))
+
+def matches_to_opcodes(matches, n, m):
+    """
+    Turn sorted (i, j, length) common runs into difflib-style opcodes.
+    """
+    opcodes = []
+    i = j = 0
+    for mi, mj, length in matches + [(n, m, 0)]:
+        if i < mi and j < mj:
+            opcodes.append(("replace", i, mi, j, mj))
+        elif i < mi:
+            opcodes.append(("delete", i, mi, j, mj))
+        elif j < mj:
+            opcodes.append(("insert", i, mi, j, mj))
+        if length:
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1] = ("equal", opcodes[-1][1], mi + length, opcodes[-1][3], mj + length)
+            else:
+                opcodes.append(("equal", mi, mi + length, mj, mj + length))
+        i, j = mi + length, mj + length
+    return opcodes
+
+# ----------------------
+# Commit Graph
+# ----------------------
+# objects/info/commit-graph holds, for every commit reachable from HEAD
+# when it was written, what history walks need from the commit object:
+#   "MGCG" | version (u32) | count (u32) | fanout: 256 x u32
+#   count x 20-byte SHA (sorted)
+#   count x row: tree SHA (20) | parent position (u32) | generation (u32) | timestamp (i64)
+#   20-byte SHA-1 of everything above
+# Rows are in SHA order; a parent is referred to by its position in that
+# order (COMMIT_GRAPH_NO_PARENT for root commits). Commits have at most one
+# parent, so the generation number (1 for a root commit, parent's + 1
+# otherwise) is also the number of commits reachable from it.
+# The graph only ever holds whole histories: a commit's parent is always in
+# it too, so a walk that reaches the graph never has to leave it.
+
+COMMIT_GRAPH_SIGNATURE = b'MGCG'
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_HEADER = struct.Struct(">4sII")
+COMMIT_GRAPH_ROW = struct.Struct(">20sIIq")
+COMMIT_GRAPH_NO_PARENT = 0xffffffff
+
+def commit_graph_path(repo):
+    return os.path.join(repo.gitdir, "objects", "info", "commit-graph")
+
+def commit_timestamp(commit):
+    """
+    Return the commit's committer time, or 0 for commits written without one.
+    """
+    return parse_ident(commit.committer or "")[1]
+
+class CommitGraph:
+    """
+    Memory-mapped commit-graph file. Commits are addressed by position;
+    nothing here inflates an object.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        sig, version, self.count = COMMIT_GRAPH_HEADER.unpack_from(self.data, 0)
+        if sig != COMMIT_GRAPH_SIGNATURE or version != COMMIT_GRAPH_VERSION:
+            raise Exception(f"Bad commit-graph {path}")
+        self.fanout = struct.unpack_from(">256I", self.data, COMMIT_GRAPH_HEADER.size)
+        self.sha_start = COMMIT_GRAPH_HEADER.size + 256 * 4
+        self.row_start = self.sha_start + 20 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for pos in range(self.count):
+            yield self.sha(pos)
+
+    def find(self, sha):
+        """
+        Return the position of sha, or None if it isn't in the graph.
+        """
+        key = bytes.fromhex(sha)
+        first = key[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        data, start = self.data, self.sha_start
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = data[start + mid * 20:start + mid * 20 + 20]
+            if cur < key:
+                lo = mid + 1
+            elif cur > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def sha(self, pos):
+        start = self.sha_start + pos * 20
+        return self.data[start:start + 20].hex()
+
+    def row(self, pos):
+        """
+        Return (tree sha, parent position or None, generation, timestamp).
+        """
+        tree, parent, generation, timestamp = COMMIT_GRAPH_ROW.unpack_from(
+            self.data, self.row_start + pos * COMMIT_GRAPH_ROW.size)
+        return tree.hex(), None if parent == COMMIT_GRAPH_NO_PARENT else parent, generation, timestamp
+
+    def parent(self, pos):
+        return self.row(pos)[1]
+
+    def generation(self, pos):
+        return self.row(pos)[2]
+
+    def walk(self, pos):
+        """
+        Yield the positions of pos and all its ancestors, newest first.
+        """
+        while pos is not None:
+            yield pos
+            pos = self.row(pos)[1]
+
+    def is_ancestor(self, a, b):
+        """
+        True if commit a is b or one of its ancestors. Generation numbers
+        drop by one per step, so we know how far back a has to be.
+        """
+        steps = self.generation(b) - self.generation(a)
+        if steps < 0:
+            return False
+        while steps:
+            b = self.parent(b)
+            steps -= 1
+        return a == b
+
+    def close(self):
+        self.data.close()
+
+def repo_commit_graph(repo):
+    """
+    Open the commit-graph once per repository object; None if there isn't one.
+    """
+    if repo.commit_graph is None:
+        path = commit_graph_path(repo)
+        if os.path.exists(path):
+            repo.commit_graph = CommitGraph(path)
+    return repo.commit_graph
+
+def commit_graph_write(repo, tip):
+    """
+    Write a commit-graph covering tip and everything it can reach. Commits
+    already in the old graph keep their rows, so only new commits are read;
+    the file itself is rewritten, since positions shift. Returns the number
+    of commits added.
+    """
+    old = repo_commit_graph(repo)
+    new = []  # (sha, tree, parent sha, timestamp), newest first
+    sha = tip
+    while sha and (old is None or old.find(sha) is None):
+        commit = object_read(repo, sha)
+        new.append((sha, commit.tree, commit.parent, commit_timestamp(commit)))
+        sha = commit.parent
+    if not new and repo_commit_meta(repo) is not None and repo_commit_bloom(repo) is not None:
+        return 0
+    rows = {}  # sha -> (tree, parent sha, generation, timestamp)
+    if old is not None:
+        for pos in range(len(old)):
+            tree, parent, generation, timestamp = old.row(pos)
+            rows[old.sha(pos)] = (tree, None if parent is None else old.sha(parent), generation, timestamp)
+    for sha, tree, parent, timestamp in reversed(new):
+        generation = rows[parent][2] + 1 if parent else 1
+        rows[sha] = (tree, parent, generation, timestamp)
+
+    shas = sorted(rows)
+    positions = {sha: pos for pos, sha in enumerate(shas)}
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    out = bytearray(COMMIT_GRAPH_HEADER.pack(COMMIT_GRAPH_SIGNATURE, COMMIT_GRAPH_VERSION, len(shas)))
+    out += struct.pack(">256I", *fanout)
+    out += b''.join(bytes.fromhex(sha) for sha in shas)
+    for sha in shas:
+        tree, parent, generation, timestamp = rows[sha]
+        parent_pos = positions[parent] if parent else COMMIT_GRAPH_NO_PARENT
+        out += COMMIT_GRAPH_ROW.pack(bytes.fromhex(tree), parent_pos, generation, timestamp)
+    checksum = hashlib.sha1(out).digest()
+    out += checksum
+
+    # Metadata columns for the same positions: old rows come from the old
+    # columns when they match the old graph, anything else is read once
+    old_meta = repo_commit_meta(repo)
+    old_idents = {}
+    if old_meta is not None:
+        for pos in range(len(old)):
+            old_idents[old.sha(pos)] = old_meta.row(pos)
+    idents = []
+    for sha in shas:
+        ident = old_idents.get(sha)
+        if ident is None:
+            commit = object_read(repo, sha)
+            ident = (commit.author, parse_ident(commit.author)[1], parse_ident(commit.committer or "")[1])
+        idents.append(ident)
+    # Changed-path filters, from the trees in rows: commits aren't read
+    old_bloom = repo_commit_bloom(repo)
+    old_filters = {}
+    if old_bloom is not None:
+        for pos in range(len(old)):
+            old_filters[old.sha(pos)] = old_bloom.filter(pos)
+    filters = []
+    for sha in shas:
+        bloom = old_filters.get(sha)
+        if bloom is None:
+            tree, parent = rows[sha][:2]
+            changes = diff_trees(repo, rows[parent][0] if parent else None, tree)
+            bloom = bloom_filter(change.path for change in changes)
+        filters.append(bloom)
+
+    path = commit_graph_path(repo)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(out)
+    os.replace(tmp, path)
+    commit_meta_write(repo, checksum, idents)
+    commit_bloom_write(repo, checksum, filters)
+    if old is not None:
+        old.close()
+    repo.commit_graph = None
+    repo.commit_meta = None
+    repo.commit_bloom = None
+    return len(new)
+
+def walk_commits(repo, sha):
+    """
+    Yield sha and its ancestors, newest first. Once the walk reaches a
+    commit in the commit-graph it continues there without reading objects.
+    """
+    graph = repo_commit_graph(repo)
+    seen = set()
+    while sha and sha not in seen:
+        pos = graph.find(sha) if graph is not None else None
+        if pos is not None:
+            for pos in graph.walk(pos):
+                yield graph.sha(pos)
+            return
+        seen.add(sha)
+        yield sha
+        sha = object_read(repo, sha).parent
+
+def iter_commits(repo, start, max_count=None, skip=0, since=None, until=None, author=None, paths=None):
+    """
+    Yield (sha, GitCommit) for start and its ancestors, newest first,
+    leaving out the first `skip` and stopping after `max_count`. Skipped
+    commits are stepped over without being read (through the commit-graph
+    when there is one), and nothing past the last one returned is walked.
+    since/until (unix times), author (a regex) and paths filter before
+    counting, see filter_commits and filter_commits_by_path.
+    """
+    shas = walk_commits(repo, start)
+    if since is not None or until is not None or author is not None:
+        shas = filter_commits(repo, shas, since, until, author)
+    if paths:
+        shas = filter_commits_by_path(repo, shas, paths)
+    stop = None if max_count is None else skip + max_count
+    for sha in itertools.islice(shas, skip, stop):
+        try:
+            commit = object_read(repo, sha)
+        except Exception as e:
+            raise Exception(f"Broken commit {sha}: {e}")
+        yield sha, commit
+
+def commit_message(commit):
+    """
+    The commit message without the "[files]" list older commits carry.
+    """
+    return commit.message.split("\n\n[files]\n", 1)[0]
+
+def commit_count(repo, sha):
+    """
+    Number of commits reachable from sha, itself included.
+    """
+    graph = repo_commit_graph(repo)
+    count = 0
+    for cur in walk_commits(repo, sha):
+        pos = graph.find(cur) if graph is not None else None
+        if pos is not None:
+            return count + graph.generation(pos)
+        count += 1
+    return count
+
+def is_ancestor(repo, a, b):
+    """
+    True if commit a is b or reachable from it.
+    """
+    graph = repo_commit_graph(repo)
+    if graph is not None:
+        pos_a, pos_b = graph.find(a), graph.find(b)
+        if pos_a is not None and pos_b is not None:
+            return graph.is_ancestor(pos_a, pos_b)
+    return any(sha == a for sha in walk_commits(repo, b))
+
+# ----------------------
+# Commit Metadata
+# ----------------------
+# objects/info/commit-meta holds columns for the commits in the commit-graph,
+# in the same (SHA) order, so log filters can scan them without reading any
+# commit:
+#   "MGCM" | version (u32) | count (u32) | SHA-1 of the commit-graph it matches
+#   author time (i64 x count) | committer time (i64 x count) | author id (u32 x count)
+#   author table: count (u32), then per author length (u16) + UTF-8 "name <email>"
+#   20-byte SHA-1 of everything above
+# Authors are interned: a history with a million commits and a hundred
+# authors stores a hundred strings. Columns are big-endian on disk and
+# loaded into array.array.
+
+COMMIT_META_SIGNATURE = b'MGCM'
+COMMIT_META_VERSION = 1
+COMMIT_META_HEADER = struct.Struct(">4sII20s")
+IDENT_RE = re.compile(r"^(.*) (\d+) ([+-]\d{4})$")
+
+def parse_ident(ident):
+    """
+    Split "name <email> 1700000000 +0200" into (name and email, unix time,
+    tz). Commits written before timestamps were recorded give (ident, 0, None).
+    """
+    m = IDENT_RE.match(ident)
+    if m is None:
+        return ident, 0, None
+    return m.group(1), int(m.group(2)), m.group(3)
+
+def make_ident(name_email, when=None):
+    when = when or datetime.now().astimezone()
+    return f"{name_email} {int(when.timestamp())} {when.strftime('%z')}"
+
+def format_ident_date(ident):
+    """
+    Format an ident's time in its own timezone, or None if it has none.
+    """
+    _, timestamp, tz = parse_ident(ident)
+    if tz is None:
+        return None
+    minutes = int(tz[1:3]) * 60 + int(tz[3:5])
+    offset = timedelta(minutes=-minutes if tz[0] == "-" else minutes)
+    return datetime.fromtimestamp(timestamp, timezone(offset)).strftime("%a %b %d %H:%M:%S %Y %z")
+
+RELATIVE_DATE_RE = re.compile(r"^(\d+)\s+(second|minute|hour|day|week)s?\s+ago$")
+
+def parse_date(text):
+    """
+    Parse a --since/--until value to a unix time: "@<unix time>", an ISO
+    date or date-time ("2024-05-01", "2024-05-01 13:00"), or "<n> <unit>s
+    ago" for seconds, minutes, hours, days or weeks.
+    """
+    text = text.strip()
+    if text.startswith("@") and text[1:].isdigit():
+        return int(text[1:])
+    m = RELATIVE_DATE_RE.match(text)
+    if m:
+        delta = timedelta(**{m.group(2) + "s": int(m.group(1))})
+        return int((datetime.now() - delta).timestamp())
+    try:
+        return int(datetime.fromisoformat(text).timestamp())
+    except ValueError:
+        raise Exception(f"Invalid date: {text}")
+
+def commit_meta_path(repo):
+    return os.path.join(repo.gitdir, "objects", "info", "commit-meta")
+
+def big_endian_array(typecode, data):
+    column = array.array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "little":
+        column.byteswap()
+    return column
+
+def big_endian_bytes(column):
+    if sys.byteorder == "little":
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+class CommitMeta:
+    """
+    Metadata columns for the commit-graph's positions.
+    """
+    def __init__(self, authors, author_times, commit_times, author_ids):
+        self.authors = authors            # list of "name <email>"
+        self.author_times = author_times  # array('q')
+        self.commit_times = commit_times  # array('q')
+        self.author_ids = author_ids      # array('I'), index into authors
+
+    def __len__(self):
+        return len(self.author_ids)
+
+    def row(self, pos):
+        """
+        Return (author ident, author time, committer time) as commit_meta_write takes it.
+        """
+        return self.authors[self.author_ids[pos]], self.author_times[pos], self.commit_times[pos]
+
+    def match(self, since=None, until=None, author=None):
+        """
+        Return a bytearray with a 1 at every position whose committer time
+        is within [since, until] and whose author matches the author regex.
+        Each filter is one pass over one column.
+        """
+        mask = bytearray(b'\x01') * len(self)
+        if since is not None:
+            mask = bytearray(m and t >= since for m, t in zip(mask, self.commit_times))
+        if until is not None:
+            mask = bytearray(m and t <= until for m, t in zip(mask, self.commit_times))
+        if author is not None:
+            pattern = re.compile(author)
+            ids = bytearray(pattern.search(a) is not None for a in self.authors)
+            mask = bytearray(m and ids[i] for m, i in zip(mask, self.author_ids))
+        return mask
+
+def commit_meta_write(repo, graph_checksum, idents):
+    """
+    Write the columns for the commit-graph with checksum graph_checksum from
+    (author ident, author time, committer time) per position.
+    """
+    authors = {}
+    author_ids = array.array("I")
+    author_times = array.array("q")
+    commit_times = array.array("q")
+    for ident, author_time, commit_time in idents:
+        name = parse_ident(ident)[0]
+        author_ids.append(authors.setdefault(name, len(authors)))
+        author_times.append(author_time)
+        commit_times.append(commit_time)
+    out = bytearray(COMMIT_META_HEADER.pack(COMMIT_META_SIGNATURE, COMMIT_META_VERSION, len(idents), graph_checksum))
+    out += big_endian_bytes(author_times) + big_endian_bytes(commit_times) + big_endian_bytes(author_ids)
+    out += struct.pack(">I", len(authors))
+    for name in authors:  # dicts keep insertion order, i.e. id order
+        raw = name.encode("utf-8", "surrogateescape")
+        out += struct.pack(">H", len(raw)) + raw
+    out += hashlib.sha1(out).digest()
+    path = commit_meta_path(repo)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(out)
+    os.replace(tmp, path)
+
+def repo_commit_meta(repo):
+    """
+    Load the metadata columns once per repository object. None if there
+    are none, or they were written for a different commit-graph.
+    """
+    if repo.commit_meta is None:
+        graph = repo_commit_graph(repo)
+        path = commit_meta_path(repo)
+        if graph is None or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        sig, version, count, graph_checksum = COMMIT_META_HEADER.unpack_from(data, 0)
+        if sig != COMMIT_META_SIGNATURE or version != COMMIT_META_VERSION:
+            raise Exception(f"Bad commit metadata {path}")
+        if graph_checksum != graph.data[-20:] or count != len(graph):
+            return None
+        pos = COMMIT_META_HEADER.size
+        author_times = big_endian_array("q", data[pos:pos + 8 * count])
+        pos += 8 * count
+        commit_times = big_endian_array("q", data[pos:pos + 8 * count])
+        pos += 8 * count
+        author_ids = big_endian_array("I", data[pos:pos + 4 * count])
+        pos += 4 * count
+        (n,) = struct.unpack_from(">I", data, pos)
+        pos += 4
+        authors = []
+        for _ in range(n):
+            (length,) = struct.unpack_from(">H", data, pos)
+            authors.append(str(data[pos + 2:pos + 2 + length], "utf-8", "surrogateescape"))
+            pos += 2 + length
+        repo.commit_meta = CommitMeta(authors, author_times, commit_times, author_ids)
+    return repo.commit_meta
+
+def filter_commits(repo, shas, since=None, until=None, author=None):
+    """
+    Yield the shas whose committer time is within [since, until] and whose
+    author matches the author regex. Commits covered by the metadata columns
+    are checked against a mask computed once; others are read.
+    """
+    graph = repo_commit_graph(repo)
+    meta = repo_commit_meta(repo)
+    mask = meta.match(since, until, author) if meta is not None else None
+    pattern = re.compile(author) if author is not None else None
+    for sha in shas:
+        pos = graph.find(sha) if mask is not None else None
+        if pos is not None:
+            if mask[pos]:
+                yield sha
+            continue
+        commit = object_read(repo, sha)
+        commit_time = parse_ident(commit.committer or "")[1]
+        if since is not None and commit_time < since:
+            continue
+        if until is not None and commit_time > until:
+            continue
+        if pattern is not None and not pattern.search(parse_ident(commit.author)[0]):
+            continue
+        yield sha
+
+# ----------------------
+# Changed-Path Bloom Filters
+# ----------------------
+# objects/info/commit-bloom holds, per commit-graph position, a Bloom filter
+# of the paths the commit changed against its parent (every changed file
+# and each directory above it). A path-limited log tests the filter first:
+# a miss means the commit certainly didn't touch the path, and only hits
+# (true or false positives) are checked against the trees.
+#   "MGBF" | version (u32) | count (u32) | SHA-1 of the commit-graph it matches
+#   count x u32: end offset of each filter in the data that follows
+#   filter data, back to back | 20-byte SHA-1 of everything above
+# Sizes follow Git: 10 bits per path and 7 probes (about 1% false positives).
+# A commit changing more than BLOOM_MAX_PATHS paths gets a one-byte filter
+# with every bit set, which matches anything.
+
+BLOOM_SIGNATURE = b'MGBF'
+BLOOM_VERSION = 1
+BLOOM_HEADER = struct.Struct(">4sII20s")
+BLOOM_BITS_PER_PATH = 10
+BLOOM_PROBES = 7
+BLOOM_MAX_PATHS = 512
+
+def bloom_key(path):
+    """
+    The two 32-bit hashes a path's probes are derived from (double hashing).
+    """
+    h1, h2 = struct.unpack(">II", hashlib.blake2b(path.encode("utf-8", "surrogateescape"), digest_size=8).digest())
+    return h1, h2 | 1
+
+def bloom_filter(paths):
+    """
+    Build the filter for a commit that changed the given files.
+    """
+    keys = set()
+    for path in paths:
+        # A directory counts as changed when anything below it is
+        while path:
+            keys.add(path)
+            path = path.rpartition("/")[0]
+    if len(keys) > BLOOM_MAX_PATHS:
+        return b'\xff'
+    bits = max(8, (len(keys) * BLOOM_BITS_PER_PATH + 7) // 8 * 8)
+    data = bytearray(bits // 8)
+    for path in keys:
+        h1, h2 = bloom_key(path)
+        for i in range(BLOOM_PROBES):
+            bit = (h1 + i * h2) % bits
+            data[bit >> 3] |= 1 << (bit & 7)
+    return bytes(data)
+
+class BloomFilters:
+    """
+    The changed-path filters for the commit-graph's positions.
+    """
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+        self.ends = struct.unpack_from(f">{count}I", data, BLOOM_HEADER.size)
+        self.data_start = BLOOM_HEADER.size + 4 * count
+
+    def filter(self, pos):
+        start = self.data_start + (self.ends[pos - 1] if pos else 0)
+        return self.data[start:self.data_start + self.ends[pos]]
+
+    def maybe_changed(self, pos, key):
+        """
+        False if the commit at pos certainly didn't change the path with
+        this bloom_key; True if it may have.
+        """
+        bloom = self.filter(pos)
+        bits = len(bloom) * 8
+        h1, h2 = key
+        for i in range(BLOOM_PROBES):
+            bit = (h1 + i * h2) % bits
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+def commit_bloom_path(repo):
+    return os.path.join(repo.gitdir, "objects", "info", "commit-bloom")
+
+def commit_bloom_write(repo, graph_checksum, filters):
+    ends = []
+    end = 0
+    for bloom in filters:
+        end += len(bloom)
+        ends.append(end)
+    out = bytearray(BLOOM_HEADER.pack(BLOOM_SIGNATURE, BLOOM_VERSION, len(filters), graph_checksum))
+    out += struct.pack(f">{len(ends)}I", *ends)
+    out += b''.join(filters)
+    out += hashlib.sha1(out).digest()
+    path = commit_bloom_path(repo)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(out)
+    os.replace(tmp, path)
+
+def repo_commit_bloom(repo):
+    """
+    Load the filters once per repository object. None if there are none,
+    or they were written for a different commit-graph.
+    """
+    if repo.commit_bloom is None:
+        graph = repo_commit_graph(repo)
+        path = commit_bloom_path(repo)
+        if graph is None or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        sig, version, count, graph_checksum = BLOOM_HEADER.unpack_from(data, 0)
+        if sig != BLOOM_SIGNATURE or version != BLOOM_VERSION:
+            raise Exception(f"Bad changed-path filters {path}")
+        if graph_checksum != graph.data[-20:] or count != len(graph):
+            return None
+        repo.commit_bloom = BloomFilters(data, count)
+    return repo.commit_bloom
+
+def tree_lookup(repo, tree_sha, path):
+    """
+    Return the SHA of the entry at path ("a/b/c") in a tree, or None. In a
+    flat tree from before nested trees (see is_flat_tree) a directory has no
+    SHA of its own; its (name, sha) entries stand in for one.
+    """
+    sha = tree_sha
+    parts = path.split("/")
+    for depth, name in enumerate(parts):
+        if sha is None:
+            return None
+        tree = object_read(repo, sha)
+        if not isinstance(tree, GitTree):
+            return None
+        if is_flat_tree(tree.entries):
+            rest = "/".join(parts[depth:])
+            for mode, entry_name, entry_sha in tree.entries:
+                if entry_name == rest:
+                    return entry_sha
+            below = tuple(sorted((entry_name, entry_sha) for mode, entry_name, entry_sha in tree.entries
+                                 if entry_name.startswith(rest + "/")))
+            return below or None
+        sha = next((entry_sha for mode, entry_name, entry_sha in tree.entries if entry_name == name), None)
+    return sha
+
+def filter_commits_by_path(repo, shas, paths):
+    """
+    Yield the shas of commits that changed any of paths (worktree-relative,
+    "/"-separated; a directory matches changes anywhere below it). Commits
+    in the commit-graph are ruled out by their Bloom filter where possible;
+    the rest are checked by looking the paths up in their and their parent's
+    trees.
+    """
+    graph = repo_commit_graph(repo)
+    bloom = repo_commit_bloom(repo)
+    keys = [bloom_key(path) for path in paths]
+    for sha in shas:
+        pos = graph.find(sha) if graph is not None else None
+        if pos is not None:
+            if bloom is not None and not any(bloom.maybe_changed(pos, key) for key in keys):
+                continue
+            tree, parent, _, _ = graph.row(pos)
+            parent_tree = graph.row(parent)[0] if parent is not None else None
+        else:
+            commit = object_read(repo, sha)
+            tree = commit.tree
+            parent_tree = object_read(repo, commit.parent).tree if commit.parent else None
+        if any(path_changed(repo, parent_tree, tree, path) for path in paths):
+            yield sha
+
+def path_changed(repo, old_tree, new_tree, path):
+    """
+    True if what is at path differs between two root trees.
+    """
+    old = tree_lookup(repo, old_tree, path)
+    new = tree_lookup(repo, new_tree, path)
+    if old == new:
+        return False
+    if isinstance(old, tuple) or isinstance(new, tuple):
+        # A directory in a flat tree against one in a nested tree: compare
+        # the files below it
+        return flat_listing(repo, old, path) != flat_listing(repo, new, path)
+    return True
+
+def flat_listing(repo, found, path):
+    if found is None or isinstance(found, tuple):
+        return found
+    if not isinstance(object_read(repo, found), GitTree):
+        return found
+    return tuple(sorted((f"{path}/{name}", sha) for name, (mode, sha) in tree_file_entries(repo, found).items()))
+
+# ----------------------
+# Ignore Rules
+# ----------------------
+# Each directory may have a .minigitignore with gitignore-style patterns:
+#   "#" comments, "!" negates, a trailing "/" matches directories only, a
+#   pattern containing "/" is anchored to its directory (otherwise it matches
+#   at any depth), "*", "?", "[...]" and "**" work as in Git.
+# Rules from parent directories apply too, and the last matching rule wins.
+# Paths are matched relative to the worktree root, directories with a
+# trailing "/".
+
+IGNORE_FILE = ".minigitignore"
+
+def _glob_to_regex(glob):
+    out = []
+    i = 0
+    n = len(glob)
+    while i < n:
+        c = glob[i]
+        if c == '*':
+            if glob.startswith('**', i):
+                at_start = i == 0 or glob[i - 1] == '/'
+                if at_start and glob.startswith('**/', i):
+                    out.append('(?:.*/)?')
+                    i += 3
+                    continue
+                if at_start and i + 2 == n:
+                    out.append('.*')
+                    i += 2
+                    continue
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = glob.find(']', i + 2 if glob.startswith('[!', i) or glob.startswith('[^', i) else i + 1)
+            if j < 0:
+                out.append('\\[')
+            else:
+                body = glob[i + 1:j]
+                if body[:1] in ('!', '^'):
+                    body = '^' + body[1:]
+                out.append('[' + body.replace('\\', '\\\\') + ']')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(glob[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+def parse_ignore_lines(lines, base):
+    """
+    Turn the lines of an ignore file in directory `base` ("" for the root,
+    else "dir/sub/") into (regex source, negated) rules.
+    """
+    rules = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.endswith("\\ "):
+            line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        elif line.startswith(("\\!", "\\#")):
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        anchored = "/" in line
+        line = line.lstrip("/")
+        body = _glob_to_regex(line)
+        if not anchored:
+            body = '(?:.*/)?' + body
+        rules.append((re.escape(base) + body + ('/' if dir_only else '/?'), negate))
+    return rules
+
+class IgnoreMatcher:
+    """
+    Every rule in effect inside one directory, compiled into a single regex.
+    Rules are tried newest first in one alternation, so the first branch that
+    matches is the rule that wins; m.lastindex tells which one it was.
+    """
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self.regex = None
+        if self.rules:
+            ordered = list(reversed(self.rules))
+            self.negated = [None] + [negate for _, negate in ordered]
+            self.regex = re.compile('|'.join(f'({src})' for src, _ in ordered))
+
+    def extend(self, rules):
+        return IgnoreMatcher(self.rules + rules) if rules else self
+
+    def ignored(self, path):
+        if self.regex is None:
+            return False
+        m = self.regex.fullmatch(path)
+        return m is not None and not self.negated[m.lastindex]
+
+class IgnoreRules:
+    """
+    Per-worktree cache of IgnoreMatchers keyed by directory. A directory
+    without its own ignore file shares its parent's matcher, so each regex is
+    compiled once per .minigitignore.
+    """
+    def __init__(self, worktree):
+        self.worktree = worktree
+        self.matchers = {}  # "dir/sub/" ("" for the root) -> IgnoreMatcher
+
+    def matcher(self, prefix, has_file=None):
+        m = self.matchers.get(prefix)
+        if m is not None:
+            return m
+        if prefix:
+            parent = self.matcher(prefix[:prefix.rstrip("/").rfind("/") + 1])
+        else:
+            parent = IgnoreMatcher()
+        path = os.path.join(self.worktree, prefix, IGNORE_FILE)
+        if has_file is None:
+            has_file = os.path.isfile(path)
+        m = parent
+        if has_file:
+            with open(path, encoding="utf-8", errors="surrogateescape") as f:
+                m = parent.extend(parse_ignore_lines(f, prefix))
+        self.matchers[prefix] = m
+        return m
+
+# ----------------------
+# Worktree Walking
+# ----------------------
+
+def list_worktree_dir(path, prefix, rules=None, has_ignore_file=None):
+    """
+    List the worktree directory at path (prefix is its relpath plus os.sep,
+    "" for the root) as (files, dirs), two lists of DirEntry. Directories
+    named .minigit and whatever the IgnoreRules exclude are left out, so
+    callers never descend into them. Returns None if path can't be listed.
+    """
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+    matcher = None
+    if rules is not None:
+        if has_ignore_file is None:
+            has_ignore_file = any(e.name == IGNORE_FILE for e in entries)
+        matcher = rules.matcher(prefix, has_ignore_file)
+    files = []
+    dirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name == ".minigit":
+                continue
+            if matcher is not None and matcher.ignored(prefix + entry.name + os.sep):
+                continue  # pruned: nothing below is ever listed
+            dirs.append(entry)
+        elif entry.is_file():
+            if matcher is not None and matcher.ignored(prefix + entry.name):
+                continue
+            files.append(entry)
+    return files, dirs
+
+def walk_worktree(repo, start=None, use_ignore=True):
+    """
+    Yield (relpath, DirEntry) for every file under start (default: the whole
+    worktree). Built on os.scandir: directories named .minigit, and
+    directories matched by .minigitignore rules, are pruned before we
+    descend into them. Callers can reuse the DirEntry's cached stat instead
+    of stat()ing the path again. Like os.walk, symlinked directories are not
+    followed.
+    """
+    start = os.path.abspath(start or repo.worktree)
+    rel = os.path.relpath(start, repo.worktree)
+    prefix = "" if rel == os.curdir else rel + os.sep
+    rules = IgnoreRules(repo.worktree) if use_ignore else None
+    stack = [(start, prefix)]
+    while stack:
+        path, prefix = stack.pop()
+        listing = list_worktree_dir(path, prefix, rules)
+        if listing is None:
+            continue
+        files, dirs = listing
+        for entry in files:
+            yield prefix + entry.name, entry
+        # Reversed so directories are popped (and yielded) in name order
+        stack.extend(sorted(((entry.path, prefix + entry.name + os.sep) for entry in dirs), reverse=True))
+
+# ----------------------
+# Untracked Cache
+# ----------------------
+# Finding untracked files means listing every directory. But a directory's
+# mtime changes whenever an entry is added, removed or renamed in it, so if
+# its mtime is the one we saw last time, last time's listing still holds.
+# The cache (the index's UNTC extension) records, per directory, its mtime,
+# the stat of its .minigitignore, its (non-ignored) file names and its
+# (non-ignored) subdirectories; status then stat()s directories instead of
+# scandir()ing them. Tracked files are kept in the listing and filtered out
+# when it is read, since committing or adding a file doesn't touch the
+# directory's mtime.
+
+class UntrackedDir:
+    __slots__ = ("mtime_ns", "ignore_sig", "files", "dirs")
+
+    def __init__(self, mtime_ns, ignore_sig, files, dirs):
+        self.mtime_ns = mtime_ns
+        self.ignore_sig = ignore_sig  # (mtime_ns, size) of .minigitignore, or None
+        self.files = files            # non-ignored file names, tracked or not
+        self.dirs = dirs              # subdirectory names to descend into
+
+# Directories modified this recently are rescanned rather than trusted: a
+# second change within the same mtime tick would otherwise go unnoticed.
+UNTRACKED_RACY_NS = 2 * 10**9
+
+UNTRACKED_DIR = struct.Struct(">qqqII")
+
+def encode_untracked_cache(cache):
+    out = bytearray(struct.pack(">I", len(cache)))
+    for prefix in sorted(cache):
+        d = cache[prefix]
+        raw = prefix.encode("utf-8", "surrogateescape")
+        ign_mtime, ign_size = d.ignore_sig or (-1, -1)
+        out += struct.pack(">H", len(raw)) + raw
+        out += UNTRACKED_DIR.pack(d.mtime_ns, ign_mtime, ign_size, len(d.files), len(d.dirs))
+        for name in d.files + d.dirs:
+            raw = name.encode("utf-8", "surrogateescape")
+            out += struct.pack(">H", len(raw)) + raw
+    return bytes(out)
+
+def decode_untracked_cache(data):
+    cache = {}
+    (count,) = struct.unpack_from(">I", data, 0)
+    pos = 4
+    def read_str():
+        nonlocal pos
+        (n,) = struct.unpack_from(">H", data, pos)
+        pos += 2 + n
+        return str(data[pos - n:pos], "utf-8", "surrogateescape")
+    for _ in range(count):
+        prefix = read_str()
+        mtime_ns, ign_mtime, ign_size, n_files, n_dirs = UNTRACKED_DIR.unpack_from(data, pos)
+        pos += UNTRACKED_DIR.size
+        files = tuple(read_str() for _ in range(n_files))
+        dirs = tuple(read_str() for _ in range(n_dirs))
+        ignore_sig = None if ign_mtime < 0 else (ign_mtime, ign_size)
+        cache[prefix] = UntrackedDir(mtime_ns, ignore_sig, files, dirs)
+    return cache
+
+def untracked_cache_invalidate(index, relpath):
+    """
+    Forget the cached listing of relpath's directory. Needed when a file
+    becomes untracked without its directory changing (rm).
+    """
+    if index.untracked is not None:
+        index.untracked.pop(relpath[:relpath.rfind(os.sep) + 1], None)
+
+def untracked_files(repo, index, tracked=(), changed_dirs=None):
+    """
+    Return the sorted untracked (and not ignored) files in the worktree,
+    using and refreshing index.untracked. Returns (files, cache_changed).
+    With changed_dirs (from fsmonitor_refresh), cached directories not in it
+    are trusted without even a stat().
+    """
+    old = index.untracked or {}
+    cache = {}
+    changed = index.untracked is None
+    rules = IgnoreRules(repo.worktree)
+    recent = time.time_ns() - UNTRACKED_RACY_NS
+    found = []
+    # (prefix, whether an ancestor's ignore rules changed)
+    stack = [("", False)]
+    while stack:
+        prefix, rules_changed = stack.pop()
+        d = old.get(prefix)
+        if changed_dirs is not None and d is not None and not rules_changed and prefix not in changed_dirs:
+            cache[prefix] = d
+            found.extend(prefix + name for name in d.files
+                         if prefix + name not in index and prefix + name not in tracked)
+            for name in d.dirs:
+                stack.append((prefix + name + os.sep, False))
+            continue
+        path = os.path.join(repo.worktree, prefix)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            changed = True
+            continue
+        try:
+            ist = os.stat(os.path.join(path, IGNORE_FILE))
+            ignore_sig = (ist.st_mtime_ns, ist.st_size)
+        except FileNotFoundError:
+            ignore_sig = None
+        own_rules_changed = d is None or d.ignore_sig != ignore_sig
+        if (d is None or rules_changed or own_rules_changed
+                or d.mtime_ns != mtime_ns or mtime_ns >= recent):
+            # Miss: list the directory for real
+            changed = True
+            listing = list_worktree_dir(path, prefix, rules, ignore_sig is not None)
+            if listing is None:
+                continue
+            files = [entry.name for entry in listing[0]]
+            dirs = [entry.name for entry in listing[1]]
+            d = UntrackedDir(mtime_ns, ignore_sig, tuple(sorted(files)), tuple(sorted(dirs)))
+        cache[prefix] = d
+        found.extend(prefix + name for name in d.files
+                     if prefix + name not in index and prefix + name not in tracked)
+        for name in d.dirs:
+            stack.append((prefix + name + os.sep, rules_changed or own_rules_changed))
+    if set(cache) != set(old):
+        changed = True
+    index.untracked = cache
+    return sorted(found), changed
+
+# ----------------------
+# Filesystem Monitor
+# ----------------------
+# "minigit fsmonitor start" runs a daemon that watches the worktree with
+# inotify and keeps a journal of changed paths. Each answer carries a token
+# ("<session>:<seq>"), and the next query asks for the changes since that
+# token. status and add store the token in the index (FSMN extension) and
+# mark entries verified clean with ENTRY_FSMONITOR_VALID. Valid entries the
+# journal doesn't mention are not even stat()ed, and neither are directories
+# the untracked cache already knows. Without a daemon (or when it can't
+# vouch for a token), everything falls back to a full scan.
+
+FSMONITOR_SOCKET = "fsmonitor.sock"
+FSMONITOR_TIMEOUT = 2.0
+FSMONITOR_JOURNAL_MAX = 100000
+ENTRY_FSMONITOR_VALID = 0x4000
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class Inotify:
+    """
+    Minimal inotify binding through ctypes (Linux, stdlib only).
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise Exception("inotify is not available on this platform.")
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Drain all queued events: list of (wd, mask, name).
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += INOTIFY_EVENT.size
+                name = buf[pos:pos + length].rstrip(b'\x00')
+                pos += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+class FSMonitorDaemon:
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_EXCL_UNLINK)
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.session = f"{os.getpid()}-{time.time_ns()}"
+        self.seq = 0
+        # The journal holds every change with seq > first_seq; journal[i]
+        # has seq journal_start + i
+        self.journal = []
+        self.journal_start = 1
+        self.first_seq = 0
+        self.watches = {}  # wd -> directory prefix ("" for the root)
+        # Set if a watch couldn't be added: then we can't vouch for anything
+        self.incomplete = False
+        self.running = True
+        self.inotify = Inotify()
+
+    def record(self, relpath):
+        self.seq += 1
+        self.journal.append(relpath)
+        if len(self.journal) > FSMONITOR_JOURNAL_MAX:
+            drop = len(self.journal) // 2
+            del self.journal[:drop]
+            self.journal_start += drop
+            self.first_seq = self.journal_start - 1
+
+    def forget_everything(self):
+        # Lost events: no earlier token can be answered any more
+        self.journal = []
+        self.journal_start = self.seq + 1
+        self.first_seq = self.seq
+
+    def watch_tree(self, prefix, record):
+        stack = [prefix]
+        while stack:
+            prefix = stack.pop()
+            path = os.path.join(self.repo.worktree, prefix)
+            try:
+                wd = self.inotify.add_watch(path, self.WATCH_MASK)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                # Usually fs.inotify.max_user_watches
+                self.incomplete = True
+                continue
+            self.watches[wd] = prefix
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name != ".minigit":
+                                stack.append(prefix + entry.name + os.sep)
+                        elif record:
+                            self.record(prefix + entry.name)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            if record:
+                self.record(prefix)
+
+    def unwatch_tree(self, prefix):
+        for wd, p in list(self.watches.items()):
+            if p.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def handle_events(self, events):
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.forget_everything()
+                continue
+            prefix = self.watches.get(wd)
+            if prefix is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if not name or (not prefix and name == ".minigit"):
+                continue
+            path = prefix + name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path + os.sep, record=True)
+                elif mask & IN_MOVED_FROM:
+                    self.unwatch_tree(path + os.sep)
+                self.record(path + os.sep)
+            else:
+                self.record(path)
+            if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                # The directory's listing changed too
+                self.record(prefix)
+
+    def answer(self, token):
+        """
+        Return (new token, changed paths) for a client holding token; changed
+        paths is None if the client has to scan everything.
+        """
+        # inotify queues events synchronously in the syscall that caused
+        # them, so draining now covers every change the client has made
+        self.handle_events(self.inotify.read_events())
+        new_token = f"{self.session}:{self.seq}"
+        session, _, seq = token.partition(":")
+        if self.incomplete or session != self.session or not seq.isdigit() or int(seq) < self.first_seq:
+            return new_token, None
+        return new_token, set(self.journal[int(seq) - self.journal_start + 1:])
+
+    def serve(self, conn):
+        with conn:
+            conn.settimeout(FSMONITOR_TIMEOUT)
+            request = b''
+            while not request.endswith(b'\n'):
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                request += chunk
+            command, _, arg = request.decode().strip().partition(" ")
+            if command == "query":
+                token, changed = self.answer(arg)
+                body = "*" if changed is None else "\x00".join(sorted(changed))
+                conn.sendall(token.encode() + b'\x00' + os.fsencode(body))
+            elif command == "ping":
+                conn.sendall(f"{self.session}:{self.seq}".encode())
+            elif command == "stop":
+                self.running = False
+                conn.sendall(b"stopping")
+
+    def run(self):
+        sock_path = os.path.join(self.repo.gitdir, FSMONITOR_SOCKET)
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(sock_path)
+        server.listen(16)
+        self.watch_tree("", record=False)
+        sel = selectors.DefaultSelector()
+        sel.register(server, selectors.EVENT_READ)
+        sel.register(self.inotify.fd, selectors.EVENT_READ)
+        try:
+            while self.running:
+                for key, _ in sel.select():
+                    if key.fileobj is server:
+                        conn, _ = server.accept()
+                        try:
+                            self.serve(conn)
+                        except OSError:
+                            pass
+                    else:
+                        self.handle_events(self.inotify.read_events())
+        finally:
+            sel.close()
+            server.close()
+            self.inotify.close()
+            if os.path.exists(sock_path):
+                os.remove(sock_path)
+
+def fsmonitor_request(repo, request):
+    """
+    Send one request to the daemon; None if it isn't running.
+    """
+    sock_path = os.path.join(repo.gitdir, FSMONITOR_SOCKET)
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(sock_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(FSMONITOR_TIMEOUT)
+            s.connect(sock_path)
+            s.sendall(request.encode() + b'\n')
+            chunks = []
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b''.join(chunks)
+    except OSError:
+        return None
+
+def fsmonitor_refresh(repo, index):
+    """
+    Ask the daemon what changed since index.fsmonitor_token, clear
+    ENTRY_FSMONITOR_VALID on affected entries and store the new token.
+    Returns (changed_dirs, dirty): changed_dirs is the set of directory
+    prefixes whose listing may have changed, or None when everything has to
+    be scanned; dirty says whether the index needs writing.
+    """
+    old_token = index.fsmonitor_token
+    reply = fsmonitor_request(repo, f"query {old_token or ''}")
+    if reply is None or b'\x00' not in reply:
+        # No daemon: forget the token and every valid flag
+        if old_token is None:
+            return None, False
+        index.fsmonitor_token = None
+        for entry in index.values():
+            entry.flags &= ~ENTRY_FSMONITOR_VALID
+        return None, True
+    token, _, body = reply.partition(b'\x00')
+    index.fsmonitor_token = token.decode()
+    dirty = index.fsmonitor_token != old_token
+    if body == b'*':
+        for entry in index.values():
+            entry.flags &= ~ENTRY_FSMONITOR_VALID
+        return None, True
+    changed = [os.fsdecode(p) for p in body.split(b'\x00')] if body else []
+    changed_dirs = set()
+    keys = None
+    for path in changed:
+        if path == "" or path.endswith(os.sep):
+            changed_dirs.add(path)
+            prefix = path
+        else:
+            changed_dirs.add(path[:path.rfind(os.sep) + 1])
+            entry = index.get(path)
+            if entry is not None:
+                entry.flags &= ~ENTRY_FSMONITOR_VALID
+            prefix = path + os.sep
+        # Everything below a changed directory (e.g. one renamed away) is
+        # suspect too
+        if keys is None:
+            keys = sorted(index)
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            index[keys[i]].flags &= ~ENTRY_FSMONITOR_VALID
+            i += 1
+    # The token moves past these changes now, so the untracked cache must
+    # not keep trusting listings of the directories they touched
+    if index.untracked is not None:
+        for prefix in changed_dirs:
+            index.untracked.pop(prefix, None)
+    return changed_dirs, dirty or bool(changed)
+
+def cmd_fsmonitor(args):
+    repo = Repository()
+    if args.action == "run":
+        FSMonitorDaemon(repo).run()
+    elif args.action == "start":
+        if fsmonitor_request(repo, "ping") is not None:
+            print("fsmonitor is already running.")
+            return
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "fsmonitor", "run"],
+                         cwd=repo.worktree, start_new_session=True, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if fsmonitor_request(repo, "ping") is not None:
+                print("fsmonitor started.")
+                return
+            time.sleep(0.05)
+        print("fsmonitor did not start.")
+    elif args.action == "stop":
+        if fsmonitor_request(repo, "stop") is None:
+            print("fsmonitor is not running.")
+        else:
+            print("fsmonitor stopped.")
+    else:
+        reply = fsmonitor_request(repo, "ping")
+        if reply is None:
+            print("fsmonitor is not running.")
+        else:
+            print(f"fsmonitor is running (token {reply.decode()}).")
+
+# ----------------------
+# Repository Session
+# ----------------------
+
+# .minigit/config is an INI file; environment variables still win over it
+CONFIG_DEFAULTS = {
+    "core": {"fsync": "none"},
+    "pack": {"window": str(PACK_WINDOW), "depth": str(PACK_DEPTH), "windowMemory": str(PACK_WINDOW_MEMORY)},
+    "cache": {"bytes": str(32 * 1024 * 1024)},
+    "diff": {"algorithm": "histogram"},
+}
+
+def read_config(repo):
+    config = configparser.ConfigParser()
+    config.read_dict(CONFIG_DEFAULTS)
+    config.read(os.path.join(repo.gitdir, "config"))
+    return config
+
+def repo_config(repo):
+    """
+    Config for repo: memoized on a Repository, re-read for a bare GitRepository.
+    """
+    if isinstance(repo, Repository):
+        return repo.config
+    return read_config(repo)
+
+def find_worktree(path):
+    """
+    Return the nearest directory at or above path that holds a .minigit.
+    """
+    path = os.path.abspath(path)
+    while not os.path.isdir(os.path.join(path, ".minigit")):
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise Exception("Not a minigit repository (or any parent directory)")
+        path = parent
+    return path
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class Repository(GitRepository):
+    """
+    A session on one repository, for commands and for tools that run many
+    operations in one process (CI bots, graph.py):
+
+        repo = Repository()          # found from the cwd or any parent
+        repo.head, repo.index, repo.config
+
+    Each is memoized until its file's mtime, size or inode changes, so outside
+    writes are picked up and nothing else is re-read. HEAD and the index are
+    loaded on first use; config is read up front, since it sizes the object
+    cache. The index is shared: save changes with write_index().
+    """
+    def __init__(self, path=None):
+        super().__init__(find_worktree(path or os.getcwd()))
+        self.head_ref = os.path.join(self.gitdir, "refs", "heads", "master")
+        self.index_path = os.path.join(self.gitdir, "index")
+        self.config_path = os.path.join(self.gitdir, "config")
+        self._loaded = {}  # name -> (file stamp, value)
+        self.config
+
+    def _load(self, name, path, loader):
+        # Stamp before loading: a write during the load leaves a stale stamp,
+        # so the next access loads again
+        stamp = file_stamp(path)
+        cached = self._loaded.get(name)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        value = loader()
+        self._loaded[name] = (stamp, value)
+        return value
+
+    def _load_config(self):
+        config = read_config(self)
+        if "MINIGIT_CACHE_BYTES" not in os.environ:
+            object_cache.resize(config.getint("cache", "bytes"))
+        return config
+
+    @property
+    def config(self):
+        return self._load("config", self.config_path, self._load_config)
+
+    @property
+    def head(self):
+        """SHA of the HEAD commit, or None before the first commit."""
+        return self._load("head", self.head_ref, lambda: head_commit(self))
+
+    @property
+    def index(self):
+        return self._load("index", self.index_path, lambda: read_index(self))
+
+    def write_index(self, index):
+        write_index(self, index)
+        self._loaded["index"] = (file_stamp(self.index_path), index)
+
+    def set_head(self, sha):
+        os.makedirs(os.path.dirname(self.head_ref), exist_ok=True)
+        with open(self.head_ref, "w") as f:
+            f.write(sha + "\n")
+        self._loaded["head"] = (file_stamp(self.head_ref), sha)
+
+# ----------------------
+# Commands
+# ----------------------
+
+def cmd_init(args):
+    repo_create(args.path)
+
+def cmd_hash_object(args):
+    repo = Repository()
+    sha = object_write_file(repo, args.file)
+    print(sha)
+
+def cmd_cat_file(args):
+    repo = Repository()
+    if args.show_type or args.show_size:
+        fmt, size = object_header(repo, args.sha)
+        print(fmt.decode() if args.show_type else size)
+    elif args.type == "blob":
+        # Stream so the first bytes go out before the whole blob is inflated
+        fmt, size, chunks = object_stream(repo, args.sha)
+        if fmt != b'blob':
+            chunks.close()
+            print(f"Object {args.sha} is a {fmt.decode()}, not a blob.")
+            return
+        out = sys.stdout.buffer
+        for chunk in chunks:
+            out.write(chunk)
+        out.flush()
+    elif args.type == "commit":
+        obj = object_read(repo, args.sha)
+        print(obj.serialize().decode())
+    elif args.type is None:
+        print("cat-file needs a type, -t or -s.")
+    else:
+        print("Unsupported type for cat-file.")
+
+def cmd_add(args):
+    repo = Repository()
+    index = repo.index
+    racy_ns = index_mtime_ns(repo)
+    to_add = {}  # relpath -> (path, stat), so each file is stored once
+    def add_file(path, relpath, st):
+        # Stat before hashing: if the file changes while it is hashed,
+        # the cached stat data won't match it afterwards
+        entry = index.get(relpath)
+        if entry is not None and stat_matches(entry, st, racy_ns):
+            return  # Unchanged since it was last added
+        to_add.setdefault(relpath, (path, st))
+    changed_dirs, _ = fsmonitor_refresh(repo, index)
+    for path in args.files:
+        if os.path.isdir(path) and changed_dirs is not None and index.untracked is not None:
+            # The daemon narrows it down: tracked files it can't vouch for,
+            # plus untracked files, are the only candidates
+            rel = os.path.relpath(path, repo.worktree)
+            prefix = "" if rel == os.curdir else rel + os.sep
+            for relpath, entry in list(index.items()):
+                if relpath.startswith(prefix) and not entry.flags & ENTRY_FSMONITOR_VALID:
+                    full = os.path.join(repo.worktree, relpath)
+                    if os.path.isfile(full):
+                        add_file(full, relpath, os.stat(full))
+            for relpath in untracked_files(repo, index, changed_dirs=changed_dirs)[0]:
+                if relpath.startswith(prefix):
+                    full = os.path.join(repo.worktree, relpath)
+                    add_file(full, relpath, os.stat(full))
+        elif os.path.isdir(path):
+            for relpath, dir_entry in walk_worktree(repo, path):
+                add_file(dir_entry.path, relpath, dir_entry.stat())
+        elif os.path.isfile(path):
+            add_file(path, os.path.relpath(path, repo.worktree), os.stat(path))
+    # Hashing may run in parallel, but results come back in a fixed order
+    # and the index is written once at the end
+    relpaths = sorted(to_add)
+    with ObjectWriter(repo, pack=args.pack) as writer:
+        shas = writer.write_files([to_add[r][0] for r in relpaths], jobs=args.jobs)
+        for relpath, sha in zip(relpaths, shas):
+            old = index.get(relpath)
+            entry = index[relpath] = IndexEntry.from_stat(sha, to_add[relpath][1])
+            if old is None or old.sha != sha or tree_mode(old) != tree_mode(entry):
+                cache_tree_invalidate(index, relpath)
+            if old is None or old.sha != sha:
+                print(f"Added {relpath} (blob SHA: {sha})")
+    repo.write_index(index)
+
+def cmd_rm(args):
+    """
+    Remove specified files from the index (untrack them).
+    """
+    repo = Repository()
+    index = repo.index
+    removed = False
+    for path in args.files:
+        relpath = os.path.relpath(path, repo.worktree)
+        if relpath in index:
+            del index[relpath]
+            untracked_cache_invalidate(index, relpath)
+            cache_tree_invalidate(index, relpath)
+            print(f"Untracked {relpath}")
+            removed = True
+        else:
+            print(f"{relpath} is not tracked.")
+    if removed:
+        repo.write_index(index)
+
+def cmd_commit(args):
+    repo = Repository()
+    index = repo.index
+    parent = repo.head
+    # The index holds the full snapshot for the next commit (it is kept after
+    # committing so its stat data can be reused), so the tree comes from it alone
+    if not index:
+        print("Nothing to commit.")
+        return
+    parent_tree = object_read(repo, parent).tree if parent else None
+    author = make_ident(f"{os.getenv('USER', 'user')} <{os.getenv('USER', 'user')}@localhost>")
+    message = args.message or f"Commit at {datetime.now()}"
+    with ObjectWriter(repo) as writer:
+        tree_sha = write_tree(repo, writer, index, parent_tree)
+        if tree_sha == parent_tree:
+            print("Nothing to commit.")
+            return
+        commit_sha = writer.write(GitCommit(tree_sha, parent, author, message), "commit")
+    # Keep the refreshed cache-tree for the next commit
+    repo.write_index(index)
+    repo.set_head(commit_sha)
+    print(f"Committed as {commit_sha}")
+
+def cmd_status(args):
+    repo = Repository()
+    index = repo.index
+    racy_ns = index_mtime_ns(repo)
+    # Staged: index differs from HEAD
+    head_tree = object_read(repo, repo.head).tree if repo.head else None
+    staged = diff_index_tree(repo, index, head_tree)
+    print("Staged files:")
+    for change in staged:
+        print(f"  {change.path} (deleted)" if change.status == "D" else f"  {change.path}")
+    # Modified/deleted: worktree differs from index
+    changed_dirs, refreshed = fsmonitor_refresh(repo, index)
+    changes, worktree_refreshed = diff_index_worktree(repo, index, racy_ns)
+    refreshed = refreshed or worktree_refreshed
+    print("Modified files:")
+    for change in changes:
+        if change.status == "M":
+            print(f"  {change.path}")
+    print("Deleted files:")
+    for change in changes:
+        if change.status == "D":
+            print(f"  {change.path}")
+    # Committed files that were untracked since aren't in the index, but
+    # aren't new either
+    committed = {change.path for change in staged if change.status == "D"}
+    # Find untracked files, skipping directories unchanged since last time
+    untracked, cache_changed = untracked_files(repo, index, committed, changed_dirs)
+    if refreshed or cache_changed:
+        repo.write_index(index)
+    print("Untracked files:")
+    for path in untracked:
+        print(f"  {path}")
+
+def resolve_tree(repo, name):
+    """
+    Tree SHA for a commit or tree SHA, or "HEAD".
+    """
+    sha = repo.head if name == "HEAD" else name
+    if not sha:
+        raise Exception(f"Unknown revision: {name}")
+    fmt, _ = object_header(repo, sha)
+    if fmt == b"commit":
+        return object_read(repo, sha).tree
+    if fmt == b"tree":
+        return sha
+    raise Exception(f"{name} is a {fmt.decode()}, not a commit or tree")
+
+def cmd_diff(args):
+    """
+    diff                 index -> worktree
+    diff --cached [rev]  rev (default HEAD) -> index
+    diff rev             rev -> worktree
+    diff rev1 rev2       rev1 -> rev2 (commits or trees)
+    """
+    repo = Repository()
+    refreshed = False
+    if args.cached:
+        if len(args.revs) > 1:
+            raise Exception("diff --cached takes at most one revision")
+        tree = resolve_tree(repo, args.revs[0]) if args.revs else resolve_tree(repo, "HEAD") if repo.head else None
+        changes = diff_index_tree(repo, repo.index, tree)
+    elif len(args.revs) > 2:
+        raise Exception("diff takes at most two revisions")
+    elif len(args.revs) == 2:
+        changes = diff_trees(repo, resolve_tree(repo, args.revs[0]), resolve_tree(repo, args.revs[1]))
+    else:
+        # Against the worktree: from the index, or from rev as in git
+        index = repo.index
+        _, refreshed = fsmonitor_refresh(repo, index)
+        if args.revs:
+            tree = resolve_tree(repo, args.revs[0])
+            changes, worktree_refreshed = diff_tree_worktree(repo, index, tree, index_mtime_ns(repo))
+        else:
+            changes, worktree_refreshed = diff_index_worktree(repo, index, index_mtime_ns(repo))
+        refreshed = refreshed or worktree_refreshed
+    algorithm = args.diff_algorithm or repo.config.get("diff", "algorithm")
+    out = sys.stdout
+    if args.name_status:
+        for change in changes:
+            out.write(f"{change.status}\t{change.path}\n")
+    elif args.stat:
+        if changes:
+            out.write(format_stat(repo, changes, algorithm=algorithm))
+    else:
+        for change in changes:
+            out.write(format_patch(repo, change, args.unified, algorithm))
+    if refreshed:
+        repo.write_index(repo.index)
+
+def cmd_log(args):
+    """
+    Simple graph traversal: Each commit points to its parent (linked list).
+    Traverses history from HEAD back to root, via the commit-graph if written.
+    One write per commit to the (block-buffered) stdout, so a pager or
+    `head` gets output as it is produced.
+    """
+    repo = Repository()
+    sha = args.sha or repo.head
+    if not sha:
+        print("No commits found.")
+        return
+    paths = []
+    for path in args.paths:
+        rel = os.path.relpath(os.path.abspath(path), repo.worktree)
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            print(f"{path} is outside the repository", file=sys.stderr)
+            sys.exit(1)
+        paths.append("" if rel == os.curdir else rel.replace(os.sep, "/"))
+    if "" in paths:
+        paths = []  # the whole worktree: no filtering
+    out = sys.stdout
+    commits = iter_commits(repo, sha, args.max_count, args.skip, args.since, args.until, args.author, paths)
+    while True:
+        try:
+            sha, commit = next(commits)
+        except StopIteration:
+            break
+        except BrokenPipeError:
+            raise
+        except Exception as e:
+            # A commit (or the tree of one) that can't be read ends the log
+            out.write(f"{e}\n")
+            break
+        message = commit_message(commit)
+        if args.oneline:
+            subject = message.split("\n", 1)[0]
+            out.write(f"{sha[:7]} {subject}\n")
+            continue
+        author = parse_ident(commit.author)[0]
+        date = format_ident_date(commit.author)
+        date = f"Date:   {date}\n" if date else ""
+        out.write(f"commit {sha}\nAuthor: {author}\n{date}Message: {message}\n\n")
+
+def cmd_commit_graph(args):
+    """
+    Write (or bring up to date) the commit-graph for HEAD's history.
+    """
+    repo = Repository()
+    if not repo.head:
+        print("No commits found.")
+        return
+    added = commit_graph_write(repo, repo.head)
+    if added:
+        print(f"Wrote commit-graph with {len(repo_commit_graph(repo))} commits ({added} new)")
+    else:
+        print("Commit-graph is up to date.")
+
+def cmd_ls_objects(args):
+    """
+    List all objects in the object database (blobs, commits, trees),
+    both loose and packed. Only object headers are inflated.
+    Uses: GitRepository, object_header, PackFile.header
+    """
+    repo = Repository()
+    types = {}
+    for sha in loose_objects(repo):
+        try:
+            types[sha] = object_header(repo, sha)[0].decode()
+        except Exception:
+            types[sha] = None
+    for pack in repo_packs(repo):
+        for sha, offset in zip(pack, pack.offsets):
+            try:
+                types[sha] = pack.header(offset)[0].decode()
+            except Exception:
+                types[sha] = None
+    for sha in sorted(types):
+        if types[sha] is None:
+            print(f"{sha} (unreadable)")
+        else:
+            print(f"{sha} {types[sha]}")
+
+def cmd_gc(args):
+    """
+    Fold every loose object and every existing pack into a single new pack,
+    then delete what was folded in.
+    """
+    repo = Repository()
+    loose = list(loose_objects(repo))
+    old_packs = list(repo_packs(repo))
+    if not loose and len(old_packs) <= 1:
+        print("Nothing to pack.")
+        return
+    shas = set(loose)
+    for pack in old_packs:
+        shas.update(pack)
+    window = args.window if args.window is not None else repo.config.getint("pack", "window")
+    depth = args.depth if args.depth is not None else repo.config.getint("pack", "depth")
+    window_memory = (args.window_memory if args.window_memory is not None
+                     else repo.config.getint("pack", "windowMemory"))
+    pack_path = pack_write(repo, shas, window=window, depth=depth, window_memory=window_memory)
+    for pack in old_packs:
+        pack.close()
+        if pack.pack_path != pack_path:
+            os.remove(pack.idx_path)
+            os.remove(pack.pack_path)
+    repo.packs = None
+    objects_dir = os.path.join(repo.gitdir, "objects")
+    for sha in loose:
+        os.remove(object_path(repo, sha))
+    for d in os.listdir(objects_dir):
+        if len(d) == 2 and not os.listdir(os.path.join(objects_dir, d)):
+            os.rmdir(os.path.join(objects_dir, d))
+    print(f"Packed {len(shas)} objects into {os.path.relpath(pack_path, repo.worktree)}")
+
+# ----------------------
+# Argument Parser
+# ----------------------
+
+def count_arg(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a number: {text}")
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {text}")
+    return value
+
+def date_arg(text):
+    try:
+        return parse_date(text)
+    except Exception as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def regex_arg(text):
+    try:
+        re.compile(text)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f"invalid regex {text!r}: {e}")
+    return text
+
+def main():
+    parser = argparse.ArgumentParser(description="miniwyag: minimal git-like tool")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_init = subparsers.add_parser("init", help="Initialize a new repository")
+    p_init.add_argument("path", nargs="?", default=".", help="Directory to initialize")
+    p_init.set_defaults(func=cmd_init)
+
+    p_hash = subparsers.add_parser("hash-object", help="Hash a file as a blob")
+    p_hash.add_argument("file", help="File to hash")
+    p_hash.set_defaults(func=cmd_hash_object)
+
+    p_cat = subparsers.add_parser("cat-file", help="Show object content")
+    p_cat.add_argument("-t", dest="show_type", action="store_true", help="Show the object's type")
+    p_cat.add_argument("-s", dest="show_size", action="store_true", help="Show the object's size")
+    p_cat.add_argument("type", nargs="?", choices=["blob", "commit"], help="Type of object")
+    p_cat.add_argument("sha", help="SHA of object")
+    p_cat.set_defaults(func=cmd_cat_file)
+
+    p_add = subparsers.add_parser("add", help="Add file(s) to index")
+    p_add.add_argument("files", nargs="+", help="Files to add")
+    p_add.add_argument("--pack", action="store_true", help="Write new blobs straight into a pack")
+    p_add.add_argument("-j", "--jobs", type=int, default=1, help="Hash and compress files in this many processes")
+    p_add.set_defaults(func=cmd_add)
+
+    p_rm = subparsers.add_parser("rm", help="Remove file(s) from index (untrack)")
+    p_rm.add_argument("files", nargs="+", help="Files to untrack")
+    p_rm.set_defaults(func=cmd_rm)
+
+    p_commit = subparsers.add_parser("commit", help="Commit staged files")
+    p_commit.add_argument("-m", "--message", help="Commit message")
+    p_commit.set_defaults(func=cmd_commit)
+
+    p_status = subparsers.add_parser("status", help="Show staged, modified, deleted and untracked files")
+    p_status.set_defaults(func=cmd_status)
+
+    p_diff = subparsers.add_parser("diff", help="Show changes between trees, commits, the index and the worktree")
+    p_diff.add_argument("revs", nargs="*", help="Up to two commit/tree SHAs (or HEAD)")
+    p_diff.add_argument("--cached", action="store_true", help="Compare the index with a revision (default: HEAD)")
+    p_diff.add_argument("--name-status", action="store_true", help="Show only the status letter and path of each change")
+    p_diff.add_argument("--stat", action="store_true", help="Show a diffstat")
+    p_diff.add_argument("-U", "--unified", type=int, default=3, help="Lines of context in patches")
+    p_diff.add_argument("--diff-algorithm", choices=LINE_DIFF_ALGORITHMS, help="Line diff algorithm (default: diff.algorithm, histogram)")
+    p_diff.add_argument("--histogram", dest="diff_algorithm", action="store_const", const="histogram", help="Same as --diff-algorithm=histogram")
+    p_diff.set_defaults(func=cmd_diff)
+
+    p_log = subparsers.add_parser("log", help="Show commit history",
+                                  usage="%(prog)s [options] [sha] [-- path ...]",
+                                  epilog="Paths after -- limit the log to commits that changed them.")
+    p_log.add_argument("sha", nargs="?", help="Start from this commit SHA (default: HEAD)")
+    p_log.add_argument("-n", "--max-count", type=count_arg, help="Show at most this many commits")
+    p_log.add_argument("--skip", type=count_arg, default=0, help="Skip this many commits before showing any")
+    p_log.add_argument("--since", type=date_arg, help="Only commits made at or after this date (ISO date, @unix-time or '<n> days ago')")
+    p_log.add_argument("--until", type=date_arg, help="Only commits made at or before this date")
+    p_log.add_argument("--author", type=regex_arg, help="Only commits whose author (name <email>) matches this regex")
+    p_log.add_argument("--oneline", action="store_true", help="Show each commit as '<short sha> <subject>'")
+    p_log.set_defaults(func=cmd_log, paths=[])
+
+    p_cg = subparsers.add_parser("commit-graph", help="Write the commit-graph file used to speed up history walks")
+    p_cg.add_argument("action", choices=["write"], help="Write or incrementally update the file")
+    p_cg.set_defaults(func=cmd_commit_graph)
+
+    p_lsobj = subparsers.add_parser("ls-objects", help="List all objects in the database")
+    p_lsobj.set_defaults(func=cmd_ls_objects)
+
+    p_fsm = subparsers.add_parser("fsmonitor", help="Run the filesystem monitor daemon (Linux/inotify)")
+    p_fsm.add_argument("action", choices=["start", "stop", "status", "run"], help="run stays in the foreground")
+    p_fsm.set_defaults(func=cmd_fsmonitor)
+
+    p_gc = subparsers.add_parser("gc", aliases=["repack"], help="Pack loose objects into a packfile")
+    p_gc.add_argument("--window", type=int, help="Objects to try as delta bases (0 disables deltas; default: pack.window)")
+    p_gc.add_argument("--depth", type=int, help="Maximum delta chain length (default: pack.depth)")
+    p_gc.add_argument("--window-memory", type=int, help="Bytes the delta window may hold (0: no limit; default: pack.windowMemory)")
+    p_gc.set_defaults(func=cmd_gc)
 
-    args = parser.parse_args()
-    args.func(args)
+    argv = sys.argv[1:]
+    paths = []
+    if argv[:1] == ["log"] and "--" in argv:
+        # log [options] [sha] -- path...: everything after "--" is a path
+        split = argv.index("--")
+        argv, paths = argv[:split], argv[split + 1:]
+    args = parser.parse_args(argv)
+    if paths:
+        args.paths = paths
+    try:
+        args.func(args)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader (head, a pager) went away: stop quietly, and point
+        # stdout at /dev/null so the flush at exit doesn't fail again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    if os.environ.get("MINIGIT_CACHE_STATS"):
+        print(object_cache.stats(), file=sys.stderr)
 
 if __name__ == "__main__":
     main()